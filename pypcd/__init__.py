@@ -1,3 +1,8 @@
 __version__ = '0.1.1'
 
-from pypcd import *
+import sys
+
+from .pypcd import *
+
+if sys.version_info >= (3, 5):
+    from .aio import aload, asave
@@ -0,0 +1,145 @@
+"""
+asyncio variants of the pcd readers and writers.
+
+The blocking work - file reads and writes, parsing and compression - runs
+in an executor, one chunk of points per step, so the event loop stays
+responsive and a load or save can be cancelled between chunks.
+
+Needs python 3.5 or newer.
+"""
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .pypcd import (PointCloud, read_header, iter_chunks, write_header,
+                    build_ascii_fmtstr, write_ascii_pc_data,
+                    point_cloud_to_fileobj, _build_dtype, _select_fields,
+                    _data_codec, _raw_bytes, _as_buffer)
+
+__all__ = ['aload', 'asave', 'max_workers']
+
+# size of the default executor, which bounds how many chunks of all
+# loads and saves in flight are worked on at once
+max_workers = 4
+
+_executor = None
+
+
+def _default_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers)
+    return _executor
+
+
+async def _run(executor, fn, *args):
+    """ Run fn(*args) in executor.
+
+    If cancelled, the step already running is allowed to finish before the
+    cancellation propagates, so it never races with the cleanup of the
+    caller.
+    """
+    loop = asyncio.get_event_loop()
+    fut = loop.run_in_executor(executor, fn, *args)
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        await asyncio.wait([fut])
+        raise
+
+
+def _readinto(f, arr):
+    if f.readinto(arr) != arr.nbytes:
+        raise IOError('unexpected end of file')
+
+
+def _next_chunk_into(chunks, out, start):
+    chunk = next(chunks)
+    out[start:start+len(chunk)] = chunk
+    return len(chunk)
+
+
+async def aload(fname, fields=None, chunk_points=1000000, executor=None):
+    """ Load a pcd file without blocking the event loop.
+
+    Same as ``point_cloud_from_path``, but the data is read and parsed in
+    the executor, chunk_points points at a time. If executor is None a
+    shared thread pool of ``max_workers`` threads is used.
+    """
+    if executor is None:
+        executor = _default_executor()
+    info = await _run(executor, read_header, fname)
+    metadata = info['metadata']
+    if fields is not None:
+        metadata = _select_fields(metadata, fields)
+    points = metadata['points']
+    out = np.empty(points, dtype=_build_dtype(metadata))
+    if metadata['data'] == 'binary' and fields is None:
+        # read straight into the output
+        f = open(fname, 'rb')
+        try:
+            f.seek(info['offset'])
+            for start in range(0, points, chunk_points):
+                await _run(executor, _readinto, f,
+                           out[start:start+chunk_points])
+        finally:
+            f.close()
+    else:
+        chunks = iter_chunks(fname, chunk_points, fields)
+        try:
+            start = 0
+            while start < points:
+                start += await _run(executor, _next_chunk_into, chunks, out,
+                                    start)
+        finally:
+            chunks.close()
+    return PointCloud(metadata, out)
+
+
+def _write_block(f, pc, start, stop, data, fmtstr):
+    pc_data = pc.pc_data[start:stop]
+    if data == 'ascii':
+        write_ascii_pc_data(f, pc_data, fmtstr)
+    else:
+        f.write(_as_buffer(_raw_bytes(pc_data)))
+
+
+async def asave(pc, fname, compression=None, fmt=None, chunk_points=1000000,
+                executor=None):
+    """ Save a pcd file without blocking the event loop.
+
+    Same as ``PointCloud.save_pcd``, but the data is formatted and written
+    in the executor, chunk_points points at a time; compressed data is
+    compressed in a single step. The file is written under a temporary
+    name and only moved to fname once complete, so a cancelled or failed
+    save leaves no partial file behind.
+    """
+    if executor is None:
+        executor = _default_executor()
+    metadata = pc.get_metadata()
+    if compression is not None:
+        metadata['data'] = compression.lower()
+    data = metadata['data']
+    if not (data in ('ascii', 'binary') or _data_codec(data) is not None):
+        raise ValueError('unknown DATA type %s' % data)
+    tmp_fname = fname + '.part'
+    f = open(tmp_fname, 'wb')
+    try:
+        if _data_codec(data) is not None:
+            await _run(executor, point_cloud_to_fileobj, pc, f, data)
+        else:
+            fmtstr = build_ascii_fmtstr(pc, fmt) if data == 'ascii' else None
+            await _run(executor, f.write,
+                       write_header(metadata).encode('ascii'))
+            for start in range(0, pc.points, chunk_points):
+                await _run(executor, _write_block, f, pc, start,
+                           start+chunk_points, data, fmtstr)
+        await _run(executor, f.close)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        f.close()
+        os.remove(tmp_fname)
+        raise
@@ -43,6 +43,8 @@ import numpy as np
 from sensor_msgs.msg import PointField
 from sensor_msgs.msg import PointCloud2
 
+from . import rgbutil
+
 # prefix to the names of dummy fields we add to get byte alignment correct. this needs to not
 # clash with any actual field names
 DUMMY_FIELD_PREFIX = '__'
@@ -123,14 +125,14 @@ def pointcloud2_to_array(cloud_msg, split_rgb=False, remove_padding=True):
 
     Reshapes the returned array to have shape (height, width), even if the height is 1.
 
-    The reason for using np.fromstring rather than struct.unpack is speed... especially
+    The reason for using np.frombuffer rather than struct.unpack is speed... especially
     for large point clouds, this will be <much> faster.
     '''
     # construct a numpy record type equivalent to the point type of this cloud
     dtype_list = pointcloud2_to_dtype(cloud_msg)
 
     # parse the cloud into an array
-    cloud_arr = np.fromstring(cloud_msg.data, dtype_list)
+    cloud_arr = np.frombuffer(cloud_msg.data, dtype_list)
 
     # remove the dummy fields that were added
     if remove_padding:
@@ -226,54 +228,50 @@ def array_to_pointcloud2(cloud_arr, stamp=None, frame_id=None, merge_rgb=False):
     cloud_msg.point_step = cloud_arr.dtype.itemsize
     cloud_msg.row_step = cloud_msg.point_step*cloud_arr.shape[1]
     cloud_msg.is_dense = all([np.isfinite(cloud_arr[fname]).all() for fname in cloud_arr.dtype.names])
-    cloud_msg.data = cloud_arr.tostring()
+    cloud_msg.data = cloud_arr.tobytes()
     return cloud_msg
 
 def merge_rgb_fields(cloud_arr):
     '''Takes an array with named np.uint8 fields 'r', 'g', and 'b', and returns an array in
     which they have been merged into a single np.float32 'rgb' field. The first byte of this
     field is the 'r' uint8, the second is the 'g', uint8, and the third is the 'b' uint8.
+    An 'a' field, if any, is merged into the alpha byte.
 
     This is the way that pcl likes to handle RGB colors for some reason.
     '''
-    r = np.asarray(cloud_arr['r'], dtype=np.uint32)
-    g = np.asarray(cloud_arr['g'], dtype=np.uint32)
-    b = np.asarray(cloud_arr['b'], dtype=np.uint32)
-    rgb_arr = np.array((r << 16) | (g << 8) | (b << 0), dtype=np.uint32)
-
-    # not sure if there is a better way to do this. i'm changing the type of the array
-    # from uint32 to float32, but i don't want any conversion to take place -jdb
-    rgb_arr.dtype = np.float32
+    channels = ('r', 'g', 'b', 'a')
 
-    # create a new array, without r, g, and b, but with rgb float32 field
+    # create a new array, without r, g, b and a, but with rgb float32 field
     new_dtype = []
     for field_name in cloud_arr.dtype.names:
         field_type, field_offset = cloud_arr.dtype.fields[field_name]
-        if field_name not in ('r', 'g', 'b'):
+        if field_name not in channels:
             new_dtype.append((field_name, field_type))
     new_dtype.append(('rgb', np.float32))
-    new_cloud_arr = np.zeros(cloud_arr.shape, new_dtype)
+    new_cloud_arr = np.empty(cloud_arr.shape, new_dtype)
 
-    # fill in the new array
+    # fill in the new array, the colors straight into the bytes of rgb
     for field_name in new_cloud_arr.dtype.names:
-        if field_name == 'rgb':
-            new_cloud_arr[field_name] = rgb_arr
-        else:
+        if field_name != 'rgb':
             new_cloud_arr[field_name] = cloud_arr[field_name]
+    rgb = new_cloud_arr['rgb']
+    for i, channel in enumerate(channels[:3]):
+        rgbutil.rgb_view(rgb)[:, i] = cloud_arr[channel].reshape(-1)
+    if 'a' in cloud_arr.dtype.names:
+        rgbutil.alpha_view(rgb)[:] = cloud_arr['a'].reshape(-1)
+    else:
+        rgbutil.alpha_view(rgb)[:] = 0
 
     return new_cloud_arr
 
-def split_rgb_field(cloud_arr):
+def split_rgb_field(cloud_arr, alpha=False):
     '''Takes an array with a named 'rgb' float32 field, and returns an array in which
-    this has been split into 3 uint 8 fields: 'r', 'g', and 'b'.
+    this has been split into 3 uint 8 fields: 'r', 'g', and 'b', and also 'a' if alpha
+    is True.
 
     (pcl stores rgb in packed 32 bit floats)
     '''
-    rgb_arr = cloud_arr['rgb'].copy()
-    rgb_arr.dtype = np.uint32
-    r = np.asarray((rgb_arr >> 16) & 255, dtype=np.uint8)
-    g = np.asarray((rgb_arr >> 8) & 255, dtype=np.uint8)
-    b = np.asarray(rgb_arr & 255, dtype=np.uint8)
+    channels = ('r', 'g', 'b', 'a') if alpha else ('r', 'g', 'b')
 
     # create a new array, without rgb, but with r, g, and b fields
     new_dtype = []
@@ -281,24 +279,24 @@ def split_rgb_field(cloud_arr):
         field_type, field_offset = cloud_arr.dtype.fields[field_name]
         if not field_name == 'rgb':
             new_dtype.append((field_name, field_type))
-    new_dtype.append(('r', np.uint8))
-    new_dtype.append(('g', np.uint8))
-    new_dtype.append(('b', np.uint8))
-    new_cloud_arr = np.zeros(cloud_arr.shape, new_dtype)
+    for channel in channels:
+        new_dtype.append((channel, np.uint8))
+    new_cloud_arr = np.empty(cloud_arr.shape, new_dtype)
 
-    # fill in the new array
+    # fill in the new array, the colors straight from the bytes of rgb
+    rgb = cloud_arr['rgb']
     for field_name in new_cloud_arr.dtype.names:
-        if field_name == 'r':
-            new_cloud_arr[field_name] = r
-        elif field_name == 'g':
-            new_cloud_arr[field_name] = g
-        elif field_name == 'b':
-            new_cloud_arr[field_name] = b
+        if field_name in channels[:3]:
+            new_cloud_arr[field_name] = rgbutil.rgb_view(rgb)[
+                :, channels.index(field_name)].reshape(cloud_arr.shape)
+        elif field_name == 'a':
+            new_cloud_arr[field_name] = \
+                rgbutil.alpha_view(rgb).reshape(cloud_arr.shape)
         else:
             new_cloud_arr[field_name] = cloud_arr[field_name]
     return new_cloud_arr
 
-def get_xyz_points(cloud_array, remove_nans=True, dtype=np.float):
+def get_xyz_points(cloud_array, remove_nans=True, dtype=np.float64):
     '''Pulls out x, y, and z columns from the cloud recordarray, and returns
 	a 3xN matrix.
     '''
@@ -9,37 +9,61 @@ dimatura@cmu.edu, 2013-2018
 - TODO better support for rgb nonsense
 """
 
-import re
+import os
+import sys
 import struct
 import copy
+import itertools
+import tempfile
+import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 from io import BytesIO as sio
 
+import zlib
+
 import numpy as np
 import warnings
 import lzf
 
+from . import rgbutil
+from . import sautil
+from . import spatial
+
 HAS_SENSOR_MSGS = True
 try:
     from sensor_msgs.msg import PointField
-    import numpy_pc2  # needs sensor_msgs
+    from . import numpy_pc2  # needs sensor_msgs
 except ImportError:
     HAS_SENSOR_MSGS = False
 
 __all__ = ['PointCloud',
+           'PCDHeader',
            'point_cloud_to_path',
            'point_cloud_to_buffer',
            'point_cloud_to_fileobj',
            'point_cloud_from_path',
            'point_cloud_from_buffer',
            'point_cloud_from_fileobj',
+           'iter_chunks',
+           'read_header',
+           'read_headers',
+           'register_codec',
+           'load_many',
            'make_xyz_point_cloud',
            'make_xyz_rgb_point_cloud',
            'make_xyz_label_point_cloud',
            'save_txt',
+           'PCDWriter',
+           'export_columns',
            'cat_point_clouds',
+           'PointCloudBuilder',
+           'merge_transformed',
            'add_fields',
            'update_field',
            'build_ascii_fmtstr',
+           'write_ascii_pc_data',
            'encode_rgb_for_pcl',
            'decode_rgb_from_pcl',
            'save_point_cloud',
@@ -74,39 +98,163 @@ numpy_pcd_type_mappings = [(np.dtype('float32'), ('F', 4)),
 numpy_type_to_pcd_type = dict(numpy_pcd_type_mappings)
 pcd_type_to_numpy_type = dict((q, p) for (p, q) in numpy_pcd_type_mappings)
 
+# size of the blocks used when reading binary data piecewise
+_READ_BLOCK_BYTES = 1 << 22
+# number of points formatted at once when writing ascii data
+_WRITE_BLOCK_POINTS = 1 << 16
+
+# compression codecs for compressed data, by name. the standard
+# binary_compressed DATA type uses lzf, like PCL; any other codec is written
+# as binary_compressed_<codec>, which PCL can't read.
+_codecs = {}
+
+
+def register_codec(name, compress, decompress):
+    """ Register a compression codec for binary_compressed_<name> data.
+
+    ``compress(buf)`` returns the compressed bytes, or None if the data
+    couldn't be compressed. ``decompress(buf, uncompressed_size)`` returns
+    the decompressed bytes.
+    """
+    _codecs[name] = (compress, decompress)
+
+
+def _data_codec(data):
+    """ Name of the codec for a DATA type, or None if it isn't compressed.
+    """
+    data = data.lower()
+    if data == 'binary_compressed':
+        return 'lzf'
+    if data.startswith('binary_compressed_') and \
+            data[len('binary_compressed_'):] in _codecs:
+        return data[len('binary_compressed_'):]
+    return None
+
+
+def _unknown_data_error(data):
+    """ ValueError for a DATA type that can't be read or written.
+    """
+    if data.lower().startswith('binary_compressed_'):
+        return ValueError('DATA type %s needs the %s codec, which is not '
+                          'registered' %
+                          (data, data[len('binary_compressed_'):]))
+    return ValueError('unknown DATA type %s' % data)
+
+
+register_codec('lzf', lzf.compress, lzf.decompress)
+register_codec('zlib', zlib.compress, lambda buf, size: zlib.decompress(buf))
+
+try:
+    import zstandard
+    register_codec('zstd',
+                   lambda buf: zstandard.ZstdCompressor().compress(buf),
+                   lambda buf, size: zstandard.ZstdDecompressor().decompress(
+                       buf, max_output_size=size))
+except ImportError:
+    pass
+
+try:
+    import lz4.block
+    register_codec('lz4',
+                   lambda buf: lz4.block.compress(buf, store_size=False),
+                   lambda buf, size: lz4.block.decompress(
+                       buf, uncompressed_size=size))
+except ImportError:
+    pass
+
+try:
+    import blosc
+    # byte-shuffled; most pcd fields are 4 bytes wide
+    register_codec('blosc',
+                   lambda buf: blosc.compress(buf, typesize=4, cname='zstd',
+                                              shuffle=blosc.SHUFFLE),
+                   lambda buf, size: blosc.decompress(buf))
+except ImportError:
+    pass
+
+
+def _to_str(value):
+    """ str from str or ascii bytes """
+    return value if isinstance(value, str) else value.decode('ascii')
+
+
+def _parse_ints(value):
+    return list(map(int, value.split()))
+
+
+def _parse_floats(value):
+    return list(map(float, value.split()))
+
+
+def _parse_strs(value):
+    return _to_str(value).split()
+
+
+def _cached(parse):
+    """ Memoize parse for the per-field header lines, which are the same
+    for all files with the same layout.
+    """
+    cache = {}
+
+    def parse_cached(value):
+        parsed = cache.get(value)
+        if parsed is None:
+            if len(cache) > 1024:
+                cache.clear()
+            parsed = cache[value] = tuple(parse(value))
+        return list(parsed)
+    return parse_cached
+
+
+# header keywords, mapped to the metadata key they set and the function
+# parsing their value. numbers are parsed straight from str or bytes.
+_header_keywords = {
+    'version': ('version', lambda v: _to_str(v).strip()),
+    'fields': ('fields', _cached(_parse_strs)),
+    # name of fields in pcd v.5
+    'columns': ('fields', _cached(_parse_strs)),
+    'size': ('size', _cached(_parse_ints)),
+    'type': ('type', _cached(_parse_strs)),
+    'count': ('count', _cached(_parse_ints)),
+    'width': ('width', int),
+    'height': ('height', int),
+    'points': ('points', int),
+    'viewpoint': ('viewpoint', _parse_floats),
+    'data': ('data', lambda v: _to_str(v).strip().lower()),
+}
+
 
 def parse_header(lines):
     """ Parse header of PCD files.
+
+    lines may be str or bytes. Handles PCD v.5 to v.7 headers.
     """
     metadata = {}
     for ln in lines:
-        if ln.startswith('#') or len(ln) < 2:
+        parts = ln.split(None, 1)
+        if not parts or parts[0][:1] in ('#', b'#'):
             continue
-        match = re.match('(\w+)\s+([\w\s\.]+)', ln)
-        if not match:
+        keyword = _header_keywords.get(_to_str(parts[0]).lower())
+        try:
+            key, parse = keyword
+            metadata[key] = parse(parts[1])
+        except (TypeError, IndexError, ValueError):
             warnings.warn("warning: can't understand line: %s" % ln)
-            continue
-        key, value = match.group(1).lower(), match.group(2)
-        if key == 'version':
-            metadata[key] = value
-        elif key in ('fields', 'type'):
-            metadata[key] = value.split()
-        elif key in ('size', 'count'):
-            metadata[key] = map(int, value.split())
-        elif key in ('width', 'height', 'points'):
-            metadata[key] = int(value)
-        elif key == 'viewpoint':
-            metadata[key] = map(float, value.split())
-        elif key == 'data':
-            metadata[key] = value.strip().lower()
-        # TODO apparently count is not required?
     # add some reasonable defaults
+    # TODO apparently count is not required?
     if 'count' not in metadata:
         metadata['count'] = [1]*len(metadata['fields'])
     if 'viewpoint' not in metadata:
+        # introduced in v.7
         metadata['viewpoint'] = [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0]
     if 'version' not in metadata:
         metadata['version'] = '.7'
+    if 'height' not in metadata:
+        metadata['height'] = 1
+    if 'points' not in metadata and 'width' in metadata:
+        metadata['points'] = metadata['width']*metadata['height']
+    if 'width' not in metadata and 'points' in metadata:
+        metadata['width'] = metadata['points'] // metadata['height']
     return metadata
 
 
@@ -151,33 +299,31 @@ DATA {data}
 def _metadata_is_consistent(metadata):
     """ Sanity check for metadata. Just some basic checks.
     """
-    checks = []
     required = ('version', 'fields', 'size', 'width', 'height', 'points',
                 'viewpoint', 'data')
-    for f in required:
-        if f not in metadata:
+    missing = [f for f in required if f not in metadata]
+    if missing:
+        for f in missing:
             print('%s required' % f)
-    checks.append((lambda m: all([k in m for k in required]),
-                   'missing field'))
-    checks.append((lambda m: len(m['type']) == len(m['count']) ==
-                   len(m['fields']),
-                   'length of type, count and fields must be equal'))
-    checks.append((lambda m: m['height'] > 0,
-                   'height must be greater than 0'))
-    checks.append((lambda m: m['width'] > 0,
-                   'width must be greater than 0'))
-    checks.append((lambda m: m['points'] > 0,
-                   'points must be greater than 0'))
-    checks.append((lambda m: m['data'].lower() in ('ascii', 'binary',
-                   'binary_compressed'),
-                   'unknown data type:'
-                   'should be ascii/binary/binary_compressed'))
-    ok = True
-    for check, msg in checks:
-        if not check(metadata):
-            print('error:', msg)
-            ok = False
-    return ok
+        print('error:', 'missing field')
+        return False
+    errors = []
+    if not (len(metadata['type']) == len(metadata['count']) ==
+            len(metadata['fields'])):
+        errors.append('length of type, count and fields must be equal')
+    if not metadata['height'] > 0:
+        errors.append('height must be greater than 0')
+    if not metadata['width'] > 0:
+        errors.append('width must be greater than 0')
+    if not metadata['points'] > 0:
+        errors.append('points must be greater than 0')
+    if not (metadata['data'].lower() in ('ascii', 'binary') or
+            _data_codec(metadata['data']) is not None):
+        errors.append('unknown data type:'
+                      'should be ascii/binary/binary_compressed')
+    for msg in errors:
+        print('error:', msg)
+    return not errors
 
 # def pcd_type_to_numpy(pcd_type, pcd_sz):
 #     """ convert from a pcd type string and size to numpy dtype."""
@@ -187,14 +333,59 @@ def _metadata_is_consistent(metadata):
 #     return typedict[pcd_type][pcd_sz]
 
 
+def _metadata_from_dtype(dtype):
+    """ Build pcl metadata for the fields of numpy structured dtype.
+
+    The point counts are left at 0.
+    """
+    md = {'version': .7,
+          'fields': [],
+          'size': [],
+          'count': [],
+          'width': 0,
+          'height': 1,
+          'viewpoint': [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0],
+          'points': 0,
+          'type': [],
+          'data': 'binary_compressed'}
+    md['fields'] = list(dtype.names)
+    for field in md['fields']:
+        type_, size_ = numpy_type_to_pcd_type[dtype.fields[field][0]]
+        md['type'].append(type_)
+        md['size'].append(size_)
+        # TODO handle multicount
+        md['count'].append(1)
+    return md
+
+
+def _layout_key(metadata):
+    return (tuple(metadata['fields']), tuple(metadata['size']),
+            tuple(metadata['type']), tuple(metadata['count']))
+
+
+# dtypes by layout key. clouds from the same sensor nearly always share a
+# layout, so this saves rebuilding the dtype for each one.
+_dtype_cache = {}
+
+
 def _build_dtype(metadata):
     """ Build numpy structured array dtype from pcl metadata.
 
     Note that fields with count > 1 are 'flattened' by creating multiple
     single-count fields.
 
+    The dtype is cached by the fields, size, type and count of metadata.
+
     *TODO* allow 'proper' multi-count fields.
     """
+    key = _layout_key(metadata)
+    dtype = _dtype_cache.get(key)
+    if dtype is None:
+        dtype = _dtype_cache[key] = _build_dtype_uncached(metadata)
+    return dtype
+
+
+def _build_dtype_uncached(metadata):
     fieldnames = []
     typenames = []
     for f, c, t, s in zip(metadata['fields'],
@@ -206,20 +397,125 @@ def _build_dtype(metadata):
             fieldnames.append(f)
             typenames.append(np_type)
         else:
-            fieldnames.extend(['%s_%04d' % (f, i) for i in xrange(c)])
+            fieldnames.extend(['%s_%04d' % (f, i) for i in range(c)])
             typenames.extend([np_type]*c)
-    dtype = np.dtype(zip(fieldnames, typenames))
+    dtype = np.dtype(list(zip(fieldnames, typenames)))
     return dtype
 
 
-def build_ascii_fmtstr(pc):
+class PCDHeader(object):
+    """ Immutable pcd header metadata.
+
+    Has the same members as the metadata of ``PointCloud``, with lists
+    stored as tuples, plus derived layout information: the numpy
+    ``dtype``, the byte ``offsets`` of each field within a point, the
+    ``point_step`` in bytes and the ROS ``point_fields``, built once. The
+    dtype is shared by all headers with the same layout. Headers are
+    hashable, so they can be used as keys.
+    """
+
+    members = ('version', 'fields', 'size', 'type', 'count', 'width',
+               'height', 'viewpoint', 'points', 'data')
+    __slots__ = members + ('dtype', 'offsets', 'point_step',
+                           '_point_fields')
+
+    def __init__(self, version, fields, size, type, count, width, height,
+                 viewpoint, points, data):
+        values = dict(version=version, fields=tuple(fields),
+                      size=tuple(size), type=tuple(type),
+                      count=tuple(count), width=width, height=height,
+                      viewpoint=tuple(viewpoint), points=points, data=data)
+        # checked once here, so clouds built from a header needn't be
+        if not (_metadata_is_consistent(values) and
+                len(values['size']) == len(values['fields']) and
+                width*height == points):
+            raise ValueError('inconsistent pcd header')
+        offsets, offset = [], 0
+        for s, c in zip(values['size'], values['count']):
+            offsets.append(offset)
+            offset += s*c
+        values['dtype'] = _build_dtype(values)
+        values['offsets'] = tuple(offsets)
+        values['point_step'] = offset
+        values['_point_fields'] = None
+        for k in self.__slots__:
+            object.__setattr__(self, k, values[k])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PCDHeader is immutable')
+
+    @staticmethod
+    def from_metadata(metadata):
+        return PCDHeader(**dict((k, metadata[k])
+                                for k in PCDHeader.members))
+
+    def to_metadata(self):
+        """ returns metadata as dictionary of lists, as used by PointCloud
+        """
+        metadata = {}
+        for k in self.members:
+            v = getattr(self, k)
+            metadata[k] = list(v) if isinstance(v, tuple) else v
+        return metadata
+
+    def replace(self, **kwargs):
+        """ returns copy with the given members replaced """
+        metadata = self.to_metadata()
+        metadata.update(kwargs)
+        return PCDHeader.from_metadata(metadata)
+
+    @property
+    def point_fields(self):
+        """ list of ROS PointFields, shared by all its users """
+        if self._point_fields is not None:
+            return self._point_fields
+        if not HAS_SENSOR_MSGS:
+            raise NotImplementedError('ROS sensor_msgs not found')
+        point_fields = []
+        for f, offset, t, s, c in zip(self.fields, self.offsets, self.type,
+                                      self.size, self.count):
+            pf = PointField()
+            pf.name = f
+            pf.offset = offset
+            pf.datatype = pcd_type_to_pc2_type[(t, s)]
+            pf.count = c
+            point_fields.append(pf)
+        object.__setattr__(self, '_point_fields', point_fields)
+        return point_fields
+
+    def __eq__(self, other):
+        return isinstance(other, PCDHeader) and \
+            all(getattr(self, k) == getattr(other, k) for k in self.members)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, k) for k in self.members))
+
+    def __repr__(self):
+        return 'PCDHeader(%s)' % ', '.join('%s=%r' % (k, getattr(self, k))
+                                           for k in self.members)
+
+
+def build_ascii_fmtstr(pc, fmt=None):
     """ Make a format string for printing to ascii.
 
     Note %.8f is minimum for rgb.
+
+    fmt is an optional dict from field name to format string, e.g.
+    ``{'x': '%.3f'}``, overriding the default for those fields.
     """
+    return _build_ascii_fmtstr(pc.get_metadata(), fmt)
+
+
+def _build_ascii_fmtstr(metadata, fmt=None):
     fmtstr = []
-    for t, cnt in zip(pc.type, pc.count):
-        if t == 'F':
+    for f, t, cnt in zip(metadata['fields'], metadata['type'],
+                         metadata['count']):
+        if fmt is not None and f in fmt:
+            fmtstr.extend([fmt[f]]*cnt)
+        elif t == 'F':
             fmtstr.extend(['%.10f']*cnt)
         elif t == 'I':
             fmtstr.extend(['%d']*cnt)
@@ -230,27 +526,137 @@ def build_ascii_fmtstr(pc):
     return fmtstr
 
 
-def parse_ascii_pc_data(f, dtype, metadata):
-    """ Use numpy to parse ascii pointcloud data.
+def write_ascii_pc_data(fileobj, pc_data, fmtstr, delimiter=' '):
+    """ Write structured array pc_data as ascii, one line per point.
+
+    fmtstr has one format string per field of pc_data. Instead of
+    formatting row by row, points are formatted a block at a time with a
+    single string formatting operation, and written in large chunks.
     """
-    return np.loadtxt(f, dtype=dtype, delimiter=' ')
+    rowfmt = delimiter.join(fmtstr) + '\n'
+    for start in range(0, len(pc_data), _WRITE_BLOCK_POINTS):
+        block = pc_data[start:start+_WRITE_BLOCK_POINTS].tolist()
+        values = tuple(itertools.chain.from_iterable(block))
+        fileobj.write(((rowfmt*len(block)) % values).encode('ascii'))
 
 
-def parse_binary_pc_data(f, dtype, metadata):
+def _select_fields(metadata, fields):
+    """ Build metadata restricted to the given fields, in the given order.
+    """
+    missing = [f for f in fields if f not in metadata['fields']]
+    if missing:
+        raise ValueError('fields not in point cloud: %s' % ' '.join(missing))
+    ixs = [metadata['fields'].index(f) for f in fields]
+    new_metadata = metadata.copy()
+    for k in ('fields', 'size', 'type', 'count'):
+        new_metadata[k] = [metadata[k][i] for i in ixs]
+    return new_metadata
+
+
+def _field_view_dtype(dtype, names):
+    """ Dtype that views only the given names of records laid out as dtype.
+    """
+    return np.dtype({'names': list(names),
+                     'formats': [dtype.fields[n][0] for n in names],
+                     'offsets': [dtype.fields[n][1] for n in names],
+                     'itemsize': dtype.itemsize})
+
+
+def _pack_fields(arr, out_dtype, out=None):
+    """ Copy the fields of out_dtype from structured array arr into a
+    packed array of out_dtype.
+    """
+    if out is None:
+        out = np.empty(len(arr), dtype=out_dtype)
+    for name in out_dtype.names:
+        out[name] = arr[name]
+    return out
+
+
+def _ascii_row_lengths(buf):
+    """ Number of tokens in each non-empty line of ascii data.
+    """
+    is_space = np.zeros(256, dtype=bool)
+    is_space[[ord(c) for c in ' \t\r\n']] = True
+    chars = np.frombuffer(buf, dtype=np.uint8)
+    space = is_space[chars]
+    starts = np.flatnonzero(~space[1:] & space[:-1]) + 1
+    if len(chars) and not space[0]:
+        starts = np.append(0, starts)
+    ends = np.append(np.flatnonzero(chars == ord('\n')), len(chars))
+    lengths = np.diff(np.append(0, np.searchsorted(starts, ends)))
+    return lengths[lengths > 0]
+
+
+def _parse_ascii_buffer(buf, dtype, out_dtype=None):
+    """ Parse ascii pointcloud data in buf into a structured array.
+
+    The whole buffer is tokenized at once into doubles (which handles nan
+    tokens), then split into one typed column per field. Multi-count fields
+    are already flattened to consecutive columns by dtype. Fields of 64 bit
+    integers can't go through doubles exactly, so those fall back to
+    np.loadtxt.
+    """
+    if out_dtype is None:
+        out_dtype = dtype
+    usecols = [dtype.names.index(n) for n in out_dtype.names]
+    if any(out_dtype.fields[n][0].kind in 'iu' and
+           out_dtype.fields[n][0].itemsize == 8 for n in out_dtype.names):
+        lines = buf.splitlines()
+        return np.atleast_1d(np.loadtxt(lines, dtype=out_dtype,
+                                        delimiter=' ', usecols=usecols))
+    values = np.fromstring(buf, dtype=np.float64, sep=' ')
+    if values.size % len(dtype) or \
+            (_ascii_row_lengths(buf) != len(dtype)).any():
+        raise ValueError('malformed ascii data')
+    values = values.reshape(-1, len(dtype))
+    pc_data = np.empty(len(values), dtype=out_dtype)
+    for name, col in zip(out_dtype.names, usecols):
+        pc_data[name] = values[:, col]
+    return pc_data
+
+
+def parse_ascii_pc_data(f, dtype, metadata, out_dtype=None):
+    """ Parse ascii pointcloud data.
+
+    If out_dtype is given only its fields (a subset of dtype) are kept.
+    """
+    return _parse_ascii_buffer(f.read(), dtype, out_dtype)
+
+
+def parse_binary_pc_data(f, dtype, metadata, out_dtype=None):
+    """ Parse binary pointcloud data.
+
+    If out_dtype is given only its fields (a subset of dtype) are kept; the
+    data is then read in blocks and each block is projected with a strided
+    view, so the full records are never held in memory at once.
+    """
     rowstep = metadata['points']*dtype.itemsize
-    # for some reason pcl adds empty space at the end of files
-    buf = f.read(rowstep)
-    return np.fromstring(buf, dtype=dtype)
+    if out_dtype is None:
+        # for some reason pcl adds empty space at the end of files
+        # so read exactly the points, straight into the array if possible
+        if hasattr(f, 'readinto'):
+            pc_data = np.empty(metadata['points'], dtype=dtype)
+            if f.readinto(pc_data) != rowstep:
+                raise IOError('unexpected end of file')
+            return pc_data
+        return np.frombuffer(f.read(rowstep), dtype=dtype).copy()
+    view_dtype = _field_view_dtype(dtype, out_dtype.names)
+    pc_data = np.empty(metadata['points'], dtype=out_dtype)
+    block_points = max(1, _READ_BLOCK_BYTES // dtype.itemsize)
+    for start in range(0, metadata['points'], block_points):
+        stop = min(start+block_points, metadata['points'])
+        buf = f.read((stop-start)*dtype.itemsize)
+        _pack_fields(np.frombuffer(buf, dtype=view_dtype), out_dtype,
+                     pc_data[start:stop])
+    return pc_data
 
 
-def parse_binary_compressed_pc_data(f, dtype, metadata):
-    """ Parse lzf-compressed data.
-    Format is undocumented but seems to be:
-    - compressed size of data (uint32)
-    - uncompressed size of data (uint32)
-    - compressed data
-    - junk
+def _read_compressed_data(f, metadata):
+    """ Read and decompress the data section of a binary_compressed pcd,
+    with the codec given by its DATA type.
     """
+    _, decompress = _codecs[_data_codec(metadata['data'])]
     fmt = 'II'
     compressed_size, uncompressed_size =\
         struct.unpack(fmt, f.read(struct.calcsize(fmt)))
@@ -258,112 +664,514 @@ def parse_binary_compressed_pc_data(f, dtype, metadata):
     # TODO what to use as second argument? if buf is None
     # (compressed > uncompressed)
     # should we read buf as raw binary?
-    buf = lzf.decompress(compressed_data, uncompressed_size)
+    buf = decompress(compressed_data, uncompressed_size)
     if len(buf) != uncompressed_size:
         raise IOError('Error decompressing data')
-    # the data is stored field-by-field
-    pc_data = np.zeros(metadata['width'], dtype=dtype)
+    return buf
+
+
+def _compressed_columns(buf, dtype, width, names=None):
+    """ Views of the per-field columns of decompressed binary_compressed
+    data, as a dict from field name to 1D array. No data is copied.
+
+    If names is given only those columns are returned.
+    """
+    if names is None:
+        names = dtype.names
+    offsets = {}
     ix = 0
-    for dti in range(len(dtype)):
-        dt = dtype[dti]
-        bytes = dt.itemsize * metadata['width']
-        column = np.fromstring(buf[ix:(ix+bytes)], dt)
-        pc_data[dtype.names[dti]] = column
-        ix += bytes
+    for name in dtype.names:
+        offsets[name] = ix
+        ix += dtype.fields[name][0].itemsize * width
+    columns = OrderedDict()
+    for name in names:
+        columns[name] = np.frombuffer(buf, dtype=dtype.fields[name][0],
+                                      count=width, offset=offsets[name])
+    return columns
+
+
+def parse_binary_compressed_pc_data(f, dtype, metadata, out_dtype=None):
+    """ Parse lzf-compressed data.
+    Format is undocumented but seems to be:
+    - compressed size of data (uint32)
+    - uncompressed size of data (uint32)
+    - compressed data
+    - junk
+
+    If out_dtype is given only its fields (a subset of dtype) are kept.
+    As the data is stored field-by-field, the other columns are skipped
+    after decompression without being parsed.
+    """
+    if out_dtype is None:
+        out_dtype = dtype
+    buf = _read_compressed_data(f, metadata)
+    # the data is stored field-by-field; scatter each column once
+    columns = _compressed_columns(buf, dtype, metadata['width'],
+                                  out_dtype.names)
+    pc_data = np.empty(metadata['width'], dtype=out_dtype)
+    for name in out_dtype.names:
+        pc_data[name] = columns[name]
     return pc_data
 
 
-def point_cloud_from_fileobj(f):
-    """ Parse pointcloud coming from file object f
+def parse_binary_compressed_pc_columns(f, dtype, metadata, out_dtype=None):
+    """ Parse lzf-compressed data into a dict of per-field columns.
+
+    Unlike ``parse_binary_compressed_pc_data`` no structured array is built;
+    the columns are read-only views over the decompressed buffer.
+    """
+    if out_dtype is None:
+        out_dtype = dtype
+    buf = _read_compressed_data(f, metadata)
+    return _compressed_columns(buf, dtype, metadata['width'],
+                               out_dtype.names)
+
+
+def _read_header_from_fileobj(f):
+    """ Read header lines from file object f and parse them.
+
+    Leaves f positioned at the first byte of the data section.
     """
     header = []
     while True:
-        ln = f.readline().strip()
+        ln = f.readline()
+        if not ln:
+            raise ValueError('end of file reached before DATA line')
+        ln = ln.strip()
         header.append(ln)
-        if ln.startswith('DATA'):
-            metadata = parse_header(header)
-            dtype = _build_dtype(metadata)
+        if ln.startswith(b'DATA'):
             break
+    return parse_header(header)
+
+
+def read_header(fname):
+    """ Read only the header of a pcd file, without its data.
+
+    Returns a dict with the parsed ``metadata``, the byte ``offset`` of the
+    data section and, for compressed data, the ``compressed_size`` and
+    ``uncompressed_size`` of the data (None otherwise).
+    """
+    with open(fname, 'rb') as f:
+        metadata = _read_header_from_fileobj(f)
+        offset = f.tell()
+        compressed_size = uncompressed_size = None
+        if _data_codec(metadata['data']) is not None:
+            fmt = 'II'
+            compressed_size, uncompressed_size =\
+                struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+    return {'metadata': metadata,
+            'offset': offset,
+            'compressed_size': compressed_size,
+            'uncompressed_size': uncompressed_size}
+
+
+@contextlib.contextmanager
+def _pool_context(pool):
+    """ Use pool, then close it and wait for its workers. On error it is
+    terminated instead, so no worker outlives the call. pool may be None.
+    """
+    try:
+        yield pool
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+
+
+def read_headers(fnames, workers=8):
+    """ ``read_header`` for many files, using a pool of threads.
+    """
+    with _pool_context(ThreadPool(workers)) as pool:
+        return pool.map(read_header, fnames)
+
+
+def point_cloud_from_fileobj(f, fields=None, columnar=False):
+    """ Parse pointcloud coming from binary file object f
+
+    If fields is a list of field names, only those fields are loaded.
+    If columnar is True the cloud stores its data as per-field columns
+    (see ``PointCloud``); for binary_compressed data these are read
+    straight from the decompressed buffer.
+    """
+    metadata = _read_header_from_fileobj(f)
+    dtype = _build_dtype(metadata)
+    out_dtype = None
+    if fields is not None:
+        metadata = _select_fields(metadata, fields)
+        out_dtype = _build_dtype(metadata)
     if metadata['data'] == 'ascii':
-        pc_data = parse_ascii_pc_data(f, dtype, metadata)
+        pc_data = parse_ascii_pc_data(f, dtype, metadata, out_dtype)
     elif metadata['data'] == 'binary':
-        pc_data = parse_binary_pc_data(f, dtype, metadata)
-    elif metadata['data'] == 'binary_compressed':
-        pc_data = parse_binary_compressed_pc_data(f, dtype, metadata)
+        pc_data = parse_binary_pc_data(f, dtype, metadata, out_dtype)
+    elif _data_codec(metadata['data']) is not None:
+        if columnar:
+            return PointCloud(metadata, parse_binary_compressed_pc_columns(
+                f, dtype, metadata, out_dtype))
+        pc_data = parse_binary_compressed_pc_data(f, dtype, metadata,
+                                                  out_dtype)
     else:
-        print('DATA field is neither "ascii" or "binary" or\
-                "binary_compressed"')
-    return PointCloud(metadata, pc_data)
+        raise _unknown_data_error(metadata['data'])
+    pc = PointCloud(metadata, pc_data)
+    if columnar:
+        pc.to_columnar()
+    return pc
 
 
-def point_cloud_from_path(fname):
+def point_cloud_from_path(fname, mmap=False, fields=None, columnar=False):
     """ load point cloud in binary format
+
+    If mmap is True (or a ``np.memmap`` mode string such as ``'r+'`` or
+    ``'c'``), the data section of a binary pcd is memory-mapped instead of
+    read, and ``pc_data`` is a ``np.memmap`` structured array; pages are only
+    read from disk when fields are accessed. Only ``binary`` data supports
+    this, since ascii and compressed data must be parsed.
+
+    If fields is a list of field names, only those fields are loaded. With
+    mmap, the selected fields are copied out of the mapping.
+
+    If columnar is True the cloud stores its data as per-field columns,
+    see ``point_cloud_from_fileobj``.
     """
     with open(fname, 'rb') as f:
-        pc = point_cloud_from_fileobj(f)
+        if not mmap:
+            return point_cloud_from_fileobj(f, fields=fields,
+                                            columnar=columnar)
+        metadata = _read_header_from_fileobj(f)
+        offset = f.tell()
+    if metadata['data'] != 'binary':
+        raise ValueError('mmap is only supported for binary data, not %s' %
+                         metadata['data'])
+    mode = 'r' if mmap is True else mmap
+    dtype = _build_dtype(metadata)
+    pc_data = np.memmap(fname, dtype=dtype, mode=mode, offset=offset,
+                        shape=(metadata['points'],))
+    if fields is not None:
+        metadata = _select_fields(metadata, fields)
+        pc_data = _pack_fields(pc_data, _build_dtype(metadata))
+    pc = PointCloud(metadata, pc_data)
+    if columnar:
+        pc.to_columnar()
     return pc
 
 
-def point_cloud_from_buffer(buf):
-    fileobj = sio.StringIO(buf)
-    pc = point_cloud_from_fileobj(fileobj)
-    fileobj.close()  # necessary?
+def _read_header_from_buffer(buf):
+    """ Find and parse the header at the start of buf.
+
+    Returns the metadata and the byte offset of the data section.
+    """
+    view = memoryview(buf)
+    n = 4096
+    while True:
+        head = view[:n].tobytes()
+        ix = head.find(b'\nDATA')
+        if ix >= 0 or head.startswith(b'DATA'):
+            ix += 1
+            end = head.find(b'\n', ix)
+            if end < 0 and n >= len(view):
+                end = len(head)
+            if end >= 0:
+                lines = [ln.strip() for ln in head[:end].split(b'\n')]
+                return parse_header(lines), min(end+1, len(view))
+        if n >= len(view):
+            raise ValueError('end of buffer reached before DATA line')
+        n *= 4
+
+
+def point_cloud_from_buffer(buf, fields=None, columnar=False, copy=True):
+    """ Parse pointcloud from bytes, bytearray or memoryview buf.
+
+    Binary data is read with ``np.frombuffer`` directly from buf. If copy is
+    False no copy is made at all: ``pc_data`` is a read-only view into buf,
+    which must then not be modified while the cloud is in use. Selecting
+    fields, or ascii and compressed data, always produce new arrays.
+    """
+    if sys.version_info[0] < 3 and isinstance(buf, memoryview):
+        # numpy on python 2 only reads old-style buffers; an array is one
+        buf = np.asarray(buf)
+    metadata, offset = _read_header_from_buffer(buf)
+    if metadata['data'] != 'binary':
+        fileobj = sio(buf)
+        pc = point_cloud_from_fileobj(fileobj, fields=fields,
+                                      columnar=columnar)
+        fileobj.close()
+        return pc
+    dtype = _build_dtype(metadata)
+    if len(buf) - offset < metadata['points']*dtype.itemsize:
+        raise ValueError('buffer is too short for %d points' %
+                         metadata['points'])
+    pc_data = np.frombuffer(buf, dtype=dtype, count=metadata['points'],
+                            offset=offset)
+    if fields is not None:
+        metadata = _select_fields(metadata, fields)
+        pc_data = _pack_fields(pc_data, _build_dtype(metadata))
+    elif copy:
+        pc_data = pc_data.copy()
+    else:
+        pc_data.flags.writeable = False
+    pc = PointCloud(metadata, pc_data)
+    if columnar:
+        pc.to_columnar()
     return pc
 
 
-def point_cloud_to_fileobj(pc, fileobj, data_compression=None):
-    """ Write pointcloud as .pcd to fileobj.
+def _chunk_columns(chunk, names):
+    return OrderedDict((name, chunk[name]) for name in names)
+
+
+def iter_chunks(fname, chunk_points=1000000, fields=None, columns=False):
+    """ Iterate over the data of a pcd file in chunks of points.
+
+    The header is parsed once and then structured arrays of at most
+    chunk_points points are yielded, all with the same dtype, so huge clouds
+    can be processed without loading them at once. If fields is a list of
+    field names, only those fields are yielded.
+
+    If columns is True, each chunk is instead a dict from field name to a
+    1D array. No data is copied to build these: they are views of the
+    chunk read from the file or, for compressed data, slices of the
+    per-field slabs of the decompressed buffer, which are read-only.
+
+    For ascii and binary data only one chunk is held in memory at a time.
+    binary_compressed data has to be decompressed as a whole, after which
+    each chunk is gathered from the per-field slabs of the decompressed
+    buffer.
+    """
+    with open(fname, 'rb') as f:
+        metadata = _read_header_from_fileobj(f)
+        dtype = _build_dtype(metadata)
+        out_dtype = dtype
+        if fields is not None:
+            out_dtype = _build_dtype(_select_fields(metadata, fields))
+        names = out_dtype.names
+        points = metadata['points']
+        if metadata['data'] == 'ascii':
+            while True:
+                lines = list(itertools.islice(f, chunk_points))
+                if not lines:
+                    break
+                chunk = _parse_ascii_buffer(b''.join(lines), dtype, out_dtype)
+                yield _chunk_columns(chunk, names) if columns else chunk
+        elif metadata['data'] == 'binary':
+            view_dtype = _field_view_dtype(dtype, names)
+            for start in range(0, points, chunk_points):
+                n = min(chunk_points, points-start)
+                chunk = np.empty(n, dtype=dtype)
+                if f.readinto(chunk) != chunk.nbytes:
+                    raise IOError('unexpected end of file')
+                if columns:
+                    yield _chunk_columns(chunk, names)
+                    continue
+                if out_dtype is not dtype:
+                    chunk = _pack_fields(chunk.view(view_dtype), out_dtype)
+                yield chunk
+        elif _data_codec(metadata['data']) is not None:
+            slabs = _compressed_columns(_read_compressed_data(f, metadata),
+                                        dtype, points, names)
+            for start in range(0, points, chunk_points):
+                stop = min(start+chunk_points, points)
+                if columns:
+                    yield OrderedDict((name, slabs[name][start:stop])
+                                      for name in names)
+                    continue
+                chunk = np.empty(stop-start, dtype=out_dtype)
+                for name in names:
+                    chunk[name] = slabs[name][start:stop]
+                yield chunk
+        else:
+            raise _unknown_data_error(metadata['data'])
+
+
+def _load_into(args):
+    """ Worker for ``load_many``. Loads a pcd file into a slice of a
+    memory-mapped output file.
+    """
+    fname, fields, out_fname, offset, dtype, points = args
+    out = np.memmap(out_fname, dtype=dtype, mode='r+', offset=offset,
+                    shape=(points,))
+    out[:] = point_cloud_from_path(fname, fields=fields).pc_data
+    out.flush()
+    del out
+
+
+def load_many(fnames, workers=4, backend='thread', concatenate=False,
+              fields=None):
+    """ Load many pcd files in parallel.
+
+    backend is ``'thread'`` or ``'process'``. Threads overlap file I/O with
+    decompression and parsing in other threads; processes also parallelize
+    the parsing itself. With the process backend the workers write the data
+    into a shared memory-mapped file instead of pickling it back, and the
+    returned clouds are views of that mapping.
+
+    Returns a list of PointClouds, or a single PointCloud with all the
+    points if concatenate is True (the clouds must have the same fields).
+    If fields is a list of field names, only those fields are loaded.
+    """
+    fnames = list(fnames)
+    if backend not in ('thread', 'process'):
+        raise ValueError('backend must be thread or process')
+    if backend == 'thread' and not concatenate:
+        with _pool_context(ThreadPool(workers)) as pool:
+            return pool.map(lambda fname: point_cloud_from_path(
+                fname, fields=fields), fnames)
+
+    # read the headers first, to lay out the output
+    metadatas = [h['metadata'] for h in read_headers(fnames, workers)]
+    if fields is not None:
+        metadatas = [_select_fields(md, fields) for md in metadatas]
+    dtypes = [_build_dtype(md) for md in metadatas]
+    if concatenate and any(dt != dtypes[0] for dt in dtypes):
+        raise ValueError('Pointclouds must have same fields')
+    offsets, nbytes = [], 0
+    for md, dt in zip(metadatas, dtypes):
+        if not concatenate:
+            # keep each cloud aligned
+            nbytes += -nbytes % 64
+        offsets.append(nbytes)
+        nbytes += md['points']*dt.itemsize
+
+    if backend == 'thread':
+        out = np.empty(nbytes, dtype=np.uint8)
+
+        def load_into(i):
+            view = np.ndarray((metadatas[i]['points'],), dtype=dtypes[i],
+                              buffer=out, offset=offsets[i])
+            view[:] = point_cloud_from_path(fnames[i], fields=fields).pc_data
+
+        with _pool_context(ThreadPool(workers)) as pool:
+            pool.map(load_into, range(len(fnames)))
+    else:
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, out_fname = tempfile.mkstemp(suffix='.pypcd', dir=shm_dir)
+        try:
+            os.ftruncate(fd, max(nbytes, 1))
+            os.close(fd)
+            out = np.memmap(out_fname, dtype=np.uint8, mode='r+',
+                            shape=(nbytes,))
+            with _pool_context(multiprocessing.Pool(workers)) as pool:
+                pool.map(_load_into, [(fname, fields, out_fname, offset, dt,
+                                       md['points'])
+                                      for fname, offset, dt, md in
+                                      zip(fnames, offsets, dtypes,
+                                          metadatas)])
+        finally:
+            # the mapping stays valid after the file is removed
+            os.unlink(out_fname)
+
+    if concatenate:
+        metadata = metadatas[0].copy()
+        metadata['points'] = sum(md['points'] for md in metadatas)
+        metadata['width'] = metadata['points']
+        metadata['height'] = 1
+        pc_data = np.ndarray((metadata['points'],), dtype=dtypes[0],
+                             buffer=out)
+        return PointCloud(metadata, pc_data)
+    return [PointCloud(md, np.ndarray((md['points'],), dtype=dt, buffer=out,
+                                      offset=offset))
+            for md, dt, offset in zip(metadatas, dtypes, offsets)]
+
+
+def _raw_bytes(arr):
+    """ Flat uint8 view of the bytes of arr, copying only if arr isn't
+    contiguous.
+    """
+    return np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+
+
+def _as_buffer(arr):
+    """ Read-only buffer over the memory of contiguous array arr, which
+    file objects can write without copying.
+    """
+    if sys.version_info[0] >= 3:
+        return memoryview(arr)
+    # python 2 file objects only take old-style buffers
+    return buffer(arr)  # noqa: F821
+
+
+def _join_columns(columns):
+    """ Concatenate the bytes of columns into one uint8 array, as the
+    codecs take it. Each column is copied once, straight into its slice.
+    """
+    joined = np.empty(sum(c.nbytes for c in columns), dtype=np.uint8)
+    ix = 0
+    for c in columns:
+        c = np.asarray(c)
+        joined[ix:ix+c.nbytes].view(c.dtype)[:] = c.reshape(-1)
+        ix += c.nbytes
+    return joined
+
+
+def _write_compressed_columns(fileobj, columns, data):
+    """ Write columns as compressed data, with the codec of DATA type data.
+    """
+    uncompressed = _join_columns(columns)
+    uncompressed_size = len(uncompressed)
+    # print("uncompressed_size = %r"%(uncompressed_size))
+    compress, _ = _codecs[_data_codec(data)]
+    buf = compress(uncompressed)
+    if buf is None:
+        # compression didn't shrink the file
+        # TODO what do to do in this case when reading?
+        buf = _as_buffer(uncompressed)
+        compressed_size = uncompressed_size
+    else:
+        compressed_size = len(buf)
+    fmt = 'II'
+    fileobj.write(struct.pack(fmt, compressed_size, uncompressed_size))
+    fileobj.write(buf)
+
+
+def point_cloud_to_fileobj(pc, fileobj, data_compression=None, fmt=None):
+    """ Write pointcloud as .pcd to binary file object fileobj.
     If data_compression is not None it overrides pc.data.
+
+    Besides ascii, binary and binary_compressed, data_compression may be
+    ``binary_compressed_<codec>`` for any registered codec other than lzf,
+    e.g. ``binary_compressed_zstd``. Note PCL can't read these.
+
+    For ascii data, fmt optionally overrides the format string of some
+    fields, see ``build_ascii_fmtstr``.
     """
     metadata = pc.get_metadata()
     if data_compression is not None:
         data_compression = data_compression.lower()
-        assert(data_compression in ('ascii', 'binary', 'binary_compressed'))
+        assert(data_compression in ('ascii', 'binary') or
+               _data_codec(data_compression) is not None)
         metadata['data'] = data_compression
 
     header = write_header(metadata)
-    fileobj.write(header)
+    fileobj.write(header.encode('ascii'))
     if metadata['data'].lower() == 'ascii':
-        fmtstr = build_ascii_fmtstr(pc)
-        np.savetxt(fileobj, pc.pc_data, fmt=fmtstr)
+        fmtstr = build_ascii_fmtstr(pc, fmt)
+        write_ascii_pc_data(fileobj, pc.pc_data, fmtstr)
     elif metadata['data'].lower() == 'binary':
-        fileobj.write(pc.pc_data.tostring('C'))
-    elif metadata['data'].lower() == 'binary_compressed':
+        fileobj.write(_as_buffer(_raw_bytes(pc.pc_data)))
+    elif _data_codec(metadata['data']) is not None:
         # TODO
         # a '_' field is ignored by pcl and breakes compressed point clouds.
         # changing '_' to '_padding' or other name fixes this.
         # admittedly padding shouldn't be compressed in the first place.
         # reorder to column-by-column
-        uncompressed_lst = []
-        for fieldname in pc.pc_data.dtype.names:
-            column = np.ascontiguousarray(pc.pc_data[fieldname]).tostring('C')
-            uncompressed_lst.append(column)
-        uncompressed = ''.join(uncompressed_lst)
-        uncompressed_size = len(uncompressed)
-        # print("uncompressed_size = %r"%(uncompressed_size))
-        buf = lzf.compress(uncompressed)
-        if buf is None:
-            # compression didn't shrink the file
-            # TODO what do to do in this case when reading?
-            buf = uncompressed
-            compressed_size = uncompressed_size
-        else:
-            compressed_size = len(buf)
-        fmt = 'II'
-        fileobj.write(struct.pack(fmt, compressed_size, uncompressed_size))
-        fileobj.write(buf)
+        _write_compressed_columns(fileobj, pc.columns.values(),
+                                  metadata['data'])
     else:
-        raise ValueError('unknown DATA type')
+        raise _unknown_data_error(metadata['data'])
     # we can't close because if it's stringio buf then we can't get value after
 
 
 def point_cloud_to_path(pc, fname):
-    with open(fname, 'w') as f:
+    with open(fname, 'wb') as f:
         point_cloud_to_fileobj(pc, f)
 
 
 def point_cloud_to_buffer(pc, data_compression=None):
-    fileobj = sio.StringIO()
+    fileobj = sio()
     point_cloud_to_fileobj(pc, fileobj, data_compression)
     return fileobj.getvalue()
 
@@ -371,24 +1179,154 @@ def point_cloud_to_buffer(pc, data_compression=None):
 def save_point_cloud(pc, fname):
     """ Save pointcloud to fname in ascii format.
     """
-    with open(fname, 'w') as f:
+    with open(fname, 'wb') as f:
         point_cloud_to_fileobj(pc, f, 'ascii')
 
 
 def save_point_cloud_bin(pc, fname):
     """ Save pointcloud to fname in binary format.
     """
-    with open(fname, 'w') as f:
+    with open(fname, 'wb') as f:
         point_cloud_to_fileobj(pc, f, 'binary')
 
 
 def save_point_cloud_bin_compressed(pc, fname):
     """ Save pointcloud to fname in binary compressed format.
     """
-    with open(fname, 'w') as f:
+    with open(fname, 'wb') as f:
         point_cloud_to_fileobj(pc, f, 'binary_compressed')
 
 
+def _write_ascii_columns(fileobj, columns, fmtstr, delimiter=' '):
+    """ Like ``write_ascii_pc_data``, for a list of 1D column arrays.
+    """
+    rowfmt = delimiter.join(fmtstr) + '\n'
+    points = len(columns[0]) if columns else 0
+    for start in range(0, points, _WRITE_BLOCK_POINTS):
+        block = [c[start:start+_WRITE_BLOCK_POINTS].tolist() for c in columns]
+        values = tuple(itertools.chain.from_iterable(zip(*block)))
+        fileobj.write(((rowfmt*len(block[0])) % values).encode('ascii'))
+
+
+def export_columns(pc, fname, fields, fmt=None, delimiter=' '):
+    """ Save some fields of pointcloud to a text file, one point per line.
+
+    fields are names of fields of ``pc.pc_data``. fmt is a format string
+    for all fields or a list with one per field; by default floats are
+    written as ``%.4f`` and integers as ``%d``.
+    """
+    missing = [f for f in fields if f not in pc.columns]
+    if missing:
+        raise ValueError('fields not in point cloud: %s' % ' '.join(missing))
+    columns = [pc.columns[f] for f in fields]
+    if fmt is None:
+        fmt = ['%.4f' if c.dtype.kind == 'f' else '%d' for c in columns]
+    elif isinstance(fmt, str):
+        fmt = [fmt]*len(fields)
+    with open(fname, 'wb') as f:
+        _write_ascii_columns(f, columns, fmt, delimiter)
+
+
+class PCDWriter(object):
+    """ Write a pcd file incrementally, e.g.::
+
+        with PCDWriter('out.pcd', pc_data.dtype) as writer:
+            for pc_data in chunks:
+                writer.append(pc_data)
+
+    fields is a numpy structured dtype or a dict with pcd ``fields``,
+    ``size``, ``type`` and ``count`` metadata. data is the DATA type, as
+    in ``point_cloud_to_fileobj``.
+
+    The header is written with space reserved for ``WIDTH`` and ``POINTS``,
+    which are filled in on close. ascii and binary data are written to the
+    file as they are appended. Compressed data is stored by column, so the
+    columns are spooled to temporary files and compressed on close; as the
+    codecs work on a single buffer, that step needs the whole cloud in
+    memory.
+    """
+
+    # characters reserved for the WIDTH and POINTS values
+    count_width = 20
+
+    def __init__(self, fname, fields, data='binary', viewpoint=None,
+                 fmt=None):
+        if isinstance(fields, np.dtype):
+            self.metadata = _metadata_from_dtype(fields)
+        else:
+            md = {'fields': list(fields['fields']),
+                  'size': list(fields['size']),
+                  'type': list(fields['type']),
+                  'count': list(fields.get('count',
+                                           [1]*len(fields['fields'])))}
+            self.metadata = _metadata_from_dtype(_build_dtype(md))
+            self.metadata.update(md)
+        if viewpoint is not None:
+            self.metadata['viewpoint'] = list(viewpoint)
+        data = data.lower()
+        assert(data in ('ascii', 'binary') or _data_codec(data) is not None)
+        self.metadata['data'] = data
+        self.dtype = _build_dtype(self.metadata)
+        self.points = 0
+        self.fileobj = open(fname, 'wb')
+        if data == 'ascii':
+            self._fmtstr = _build_ascii_fmtstr(self.metadata, fmt)
+        if _data_codec(data) is not None:
+            self._spools = [tempfile.TemporaryFile() for _ in self.dtype.names]
+        else:
+            self._write_header(0)
+
+    def _write_header(self, points):
+        metadata = self.metadata.copy()
+        metadata['width'] = metadata['points'] = \
+            str(points).ljust(self.count_width)
+        self.fileobj.write(write_header(metadata).encode('ascii'))
+
+    def append(self, pc_data):
+        """ Append structured array or PointCloud pc_data.
+
+        Its fields are matched by name to the fields of the file.
+        """
+        if isinstance(pc_data, PointCloud):
+            pc_data = pc_data.pc_data
+        if pc_data.dtype != self.dtype:
+            pc_data = _pack_fields(pc_data, self.dtype)
+        if self.metadata['data'] == 'ascii':
+            write_ascii_pc_data(self.fileobj, pc_data, self._fmtstr)
+        elif self.metadata['data'] == 'binary':
+            self.fileobj.write(_as_buffer(_raw_bytes(pc_data)))
+        else:
+            for name, spool in zip(self.dtype.names, self._spools):
+                spool.write(_as_buffer(_raw_bytes(pc_data[name])))
+        self.points += len(pc_data)
+
+    def close(self):
+        """ Finish the file. Called on exit of a with block.
+        """
+        if self.fileobj.closed:
+            return
+        if _data_codec(self.metadata['data']) is not None:
+            columns = []
+            for name, spool in zip(self.dtype.names, self._spools):
+                spool.seek(0)
+                columns.append(np.fromfile(spool,
+                                           dtype=self.dtype.fields[name][0]))
+                spool.close()
+            self._write_header(self.points)
+            _write_compressed_columns(self.fileobj, columns,
+                                      self.metadata['data'])
+        else:
+            self.fileobj.seek(0)
+            self._write_header(self.points)
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def save_xyz_label(pc, fname, use_default_lbl=False):
     """ Save a simple (x y z label) pointcloud, ignoring all other features.
     Label is initialized to 1000, for an obscure program I use.
@@ -396,13 +1334,13 @@ def save_xyz_label(pc, fname, use_default_lbl=False):
     md = pc.get_metadata()
     if not use_default_lbl and ('label' not in md['fields']):
         raise Exception('label is not a field in this point cloud')
-    with open(fname, 'w') as f:
-        for i in xrange(pc.points):
-            x, y, z = ['%.4f' % d for d in (
-                pc.pc_data['x'][i], pc.pc_data['y'][i], pc.pc_data['z'][i]
-                )]
-            lbl = '1000' if use_default_lbl else pc.pc_data['label'][i]
-            f.write(' '.join((x, y, z, lbl))+'\n')
+    columns = [pc.columns['x'], pc.columns['y'], pc.columns['z']]
+    if use_default_lbl:
+        columns.append(np.full(pc.points, 1000, dtype=np.int32))
+    else:
+        columns.append(pc.columns['label'])
+    with open(fname, 'wb') as f:
+        _write_ascii_columns(f, columns, ['%.4f', '%.4f', '%.4f', '%d'])
 
 
 def save_xyz_intensity_label(pc, fname, use_default_lbl=False):
@@ -413,41 +1351,52 @@ def save_xyz_intensity_label(pc, fname, use_default_lbl=False):
         raise Exception('label is not a field in this point cloud')
     if 'intensity' not in md['fields']:
         raise Exception('intensity is not a field in this point cloud')
-    with open(fname, 'w') as f:
-        for i in xrange(pc.points):
-            x, y, z = ['%.4f' % d for d in (
-                pc.pc_data['x'][i], pc.pc_data['y'][i], pc.pc_data['z'][i]
-                )]
-            intensity = '%.4f' % pc.pc_data['intensity'][i]
-            lbl = '1000' if use_default_lbl else pc.pc_data['label'][i]
-            f.write(' '.join((x, y, z, intensity, lbl))+'\n')
+    columns = [pc.columns['x'], pc.columns['y'], pc.columns['z'],
+               pc.columns['intensity']]
+    if use_default_lbl:
+        columns.append(np.full(pc.points, 1000, dtype=np.int32))
+    else:
+        columns.append(pc.columns['label'])
+    with open(fname, 'wb') as f:
+        _write_ascii_columns(f, columns,
+                             ['%.4f', '%.4f', '%.4f', '%.4f', '%d'])
 
 
-def save_txt(pc, fname, header=True):
+def save_txt(pc, fname, header=True, fmt=None, delimiter=' '):
     """ Save to csv-style text file, separated by spaces.
 
+    fmt optionally overrides the format string of some fields, see
+    ``build_ascii_fmtstr``.
+
     TODO:
     - support multi-count fields.
-    - other delimiters.
     """
-    with open(fname, 'w') as f:
+    with open(fname, 'wb') as f:
         if header:
             header_lst = []
             for field_name, cnt in zip(pc.fields, pc.count):
                 if cnt == 1:
                     header_lst.append(field_name)
                 else:
-                    for c in xrange(cnt):
+                    for c in range(cnt):
                         header_lst.append('%s_%04d' % (field_name, c))
-            f.write(' '.join(header_lst)+'\n')
-        fmtstr = build_ascii_fmtstr(pc)
-        np.savetxt(f, pc.pc_data, fmt=fmtstr)
+            f.write((delimiter.join(header_lst)+'\n').encode('ascii'))
+        fmtstr = build_ascii_fmtstr(pc, fmt)
+        write_ascii_pc_data(f, pc.pc_data, fmtstr, delimiter)
 
 
 def update_field(pc, field, pc_data):
     """ Updates field in-place.
     """
-    pc.pc_data[field] = pc_data
+    if pc.is_columnar:
+        # columns may be read-only views, so replace rather than write
+        column = np.empty_like(pc.columns[field])
+        column[:] = pc_data
+        pc.columns[field] = column
+    else:
+        pc.pc_data[field] = pc_data
+    if field in ('x', 'y', 'z'):
+        pc.invalidate_index()
     return pc
 
 
@@ -468,52 +1417,199 @@ def add_fields(pc, metadata, pc_data):
     new_metadata['size'].extend(metadata['size'])
     new_metadata['type'].extend(metadata['type'])
 
-    # parse metadata to add
-    # TODO factor this
-    fieldnames, typenames = [], []
-    for f, c, t, s in zip(metadata['fields'],
-                          metadata['count'],
-                          metadata['type'],
-                          metadata['size']):
-        np_type = pcd_type_to_numpy_type[(t, s)]
-        if c == 1:
-            fieldnames.append(f)
-            typenames.append(np_type)
-        else:
-            fieldnames.extend(['%s_%04d' % (f, i) for i in xrange(c)])
-            typenames.extend([np_type]*c)
-    dtype = zip(fieldnames, typenames)
-    # new dtype. could be inferred?
-    new_dtype = [(f, pc.pc_data.dtype[f])
-                 for f in pc.pc_data.dtype.names] + dtype
-
-    new_data = np.empty(len(pc.pc_data), new_dtype)
-    for n in pc.pc_data.dtype.names:
-        new_data[n] = pc.pc_data[n]
+    fieldnames = _build_dtype(metadata).names
+    new_dtype = _build_dtype(new_metadata)
+
+    new_data = np.empty(pc.points, new_dtype)
+    for n, column in pc.columns.items():
+        new_data[n] = column
     for n, n_tmp in zip(fieldnames, pc_data.dtype.names):
         new_data[n] = pc_data[n_tmp]
 
     # TODO maybe just all the metadata in the dtype.
     # TODO maybe use composite structured arrays for fields with count > 1
-    newpc = PointCloud(new_metadata, new_data)
+    newpc = PointCloud(new_metadata, new_data, validate=False)
     return newpc
 
 
-def cat_point_clouds(pc1, pc2):
-    """ Concatenate two point clouds into bigger point cloud.
+def cat_point_clouds(*pcs):
+    """ Concatenate point clouds into bigger point cloud.
     Point clouds must have same metadata.
+
+    All the clouds are concatenated at once, so prefer
+    ``cat_point_clouds(*pcs)`` to repeated pairwise calls, or use a
+    ``PointCloudBuilder`` when clouds arrive one by one.
     """
-    if len(pc1.fields) != len(pc2.fields):
-        raise ValueError("Pointclouds must have same fields")
-    new_metadata = pc1.get_metadata()
-    new_data = np.concatenate((pc1.pc_data, pc2.pc_data))
+    if not pcs:
+        raise ValueError("Need at least one pointcloud")
+    for pc in pcs[1:]:
+        if len(pc.fields) != len(pcs[0].fields):
+            raise ValueError("Pointclouds must have same fields")
+    new_metadata = pcs[0].get_metadata()
+    if all(pc.is_columnar for pc in pcs):
+        new_data = dict((n, np.concatenate([pc.columns[n] for pc in pcs]))
+                        for n in pcs[0].columns)
+    else:
+        new_data = np.concatenate([pc.pc_data for pc in pcs])
     # TODO this only makes sense for unstructured pc?
-    new_metadata['width'] = pc1.width+pc2.width
-    new_metadata['points'] = pc1.points+pc2.points
-    pc3 = PointCloud(new_metadata, new_data)
+    new_metadata['width'] = sum(pc.width for pc in pcs)
+    new_metadata['points'] = sum(pc.points for pc in pcs)
+    pc3 = PointCloud(new_metadata, new_data, validate=False)
     return pc3
 
 
+class PointCloudBuilder(object):
+    """ Accumulate points into a single PointCloud.
+
+    Points are appended to a preallocated buffer that grows geometrically,
+    so accumulating many clouds costs amortized linear time, unlike
+    repeated ``cat_point_clouds``. ``build`` returns a cloud viewing the
+    buffer, without a final copy.
+
+    metadata is optional pcd metadata for the result; by default it is
+    taken from the first appended PointCloud, or built from the dtype of
+    the first appended array.
+    """
+
+    def __init__(self, metadata=None, capacity=1024, growth=2.0):
+        self.metadata = None
+        self._buf = None
+        self.points = 0
+        self.capacity = capacity
+        self.growth = growth
+        if metadata is not None:
+            self._init(metadata)
+
+    def _init(self, metadata):
+        self.metadata = copy.deepcopy(metadata)
+        self._buf = np.empty(self.capacity, dtype=_build_dtype(metadata))
+
+    def append(self, pc):
+        """ Append a PointCloud or structured array with the same fields.
+        """
+        if isinstance(pc, PointCloud):
+            if self.metadata is None:
+                self._init(pc.get_metadata())
+            pc_data = pc.pc_data
+        else:
+            pc_data = pc
+            if self.metadata is None:
+                self._init(_metadata_from_dtype(pc_data.dtype))
+        if pc_data.dtype != self._buf.dtype:
+            raise ValueError("Pointclouds must have same fields")
+        n = self.points + len(pc_data)
+        if n > len(self._buf):
+            capacity = max(n, int(len(self._buf)*self.growth))
+            buf = np.empty(capacity, dtype=self._buf.dtype)
+            buf[:self.points] = self._buf[:self.points]
+            self._buf = buf
+        self._buf[self.points:n] = pc_data
+        self.points = n
+
+    def build(self):
+        """ PointCloud with all points appended so far.
+
+        Its data is a view of the builder buffer. Appending more points
+        afterwards doesn't modify it.
+        """
+        if self.metadata is None:
+            raise ValueError("No points appended")
+        metadata = copy.deepcopy(self.metadata)
+        metadata['width'] = metadata['points'] = self.points
+        metadata['height'] = 1
+        return PointCloud(metadata, self._buf[:self.points], validate=False)
+
+
+def merge_transformed(clouds, poses, out=None, workers=1, fields=None,
+                      data='binary'):
+    """ Transform each of clouds by its pose and merge them into one cloud.
+
+    clouds is a sequence of PointClouds or pcd file names, with the same
+    fields, and poses a sequence of 4x4 transforms, see
+    ``sautil.transform_cloud_array``; the clouds themselves are not
+    modified. If fields is a list of field names, only those are kept.
+
+    The output is allocated once and each cloud is copied and transformed
+    straight into its slice, with workers threads if workers > 1. out is
+
+    - None: a new PointCloud is returned.
+    - A structured array with room for all the points: it is filled and a
+      PointCloud viewing it is returned.
+    - A file name or ``PCDWriter``: the clouds are appended to the pcd
+      file as they are transformed, with DATA type data for a file name,
+      so the merged cloud is never in memory. Nothing is returned.
+    """
+    clouds = list(clouds)
+    if len(clouds) != len(poses):
+        raise ValueError('got %d poses for %d clouds' %
+                         (len(poses), len(clouds)))
+    if not clouds:
+        raise ValueError("Need at least one pointcloud")
+    paths = [c for c in clouds if not isinstance(c, PointCloud)]
+    headers = iter(h['metadata'] for h in read_headers(paths)) \
+        if paths else None
+    metadatas = [c.get_metadata() if isinstance(c, PointCloud)
+                 else next(headers) for c in clouds]
+    if fields is not None:
+        metadatas = [_select_fields(md, fields) for md in metadatas]
+    for md in metadatas[1:]:
+        if md['fields'] != metadatas[0]['fields']:
+            raise ValueError("Pointclouds must have same fields")
+    metadata = metadatas[0]
+    dtype = _build_dtype(metadata)
+    counts = [md['points'] for md in metadatas]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def transform_into(i, dest):
+        cloud = clouds[i]
+        if not isinstance(cloud, PointCloud):
+            cloud = point_cloud_from_path(cloud, fields=fields)
+        _pack_fields(cloud.columns, dest.dtype, out=dest)
+        sautil.transform_cloud_array(poses[i], dest)
+        return dest
+
+    pool = ThreadPool(workers) if workers > 1 else None
+    with _pool_context(pool):
+        if out is not None and not isinstance(out, np.ndarray):
+            writer = out
+            if not isinstance(out, PCDWriter):
+                writer = PCDWriter(out, metadata, data=data)
+            try:
+                # a window of clouds at a time, so memory stays bounded
+                window = max(workers, 1)
+                for start in range(0, len(clouds), window):
+                    ixs = range(start, min(start+window, len(clouds)))
+                    jobs = [(i, np.empty(counts[i], dtype=writer.dtype))
+                            for i in ixs]
+                    if pool is not None:
+                        done = pool.map(lambda a: transform_into(*a), jobs)
+                    else:
+                        done = [transform_into(*a) for a in jobs]
+                    for pc_data in done:
+                        writer.append(pc_data)
+            finally:
+                if writer is not out:
+                    writer.close()
+            return None
+        if out is None:
+            out = np.empty(offsets[-1], dtype=dtype)
+        elif out.dtype != dtype or len(out) < offsets[-1]:
+            raise ValueError('out must be an array of %d points of %s' %
+                             (offsets[-1], dtype))
+        jobs = [(i, out[offsets[i]:offsets[i+1]])
+                for i in range(len(clouds))]
+        if pool is not None:
+            pool.map(lambda a: transform_into(*a), jobs)
+        else:
+            for job in jobs:
+                transform_into(*job)
+    metadata = copy.deepcopy(metadata)
+    metadata['width'] = metadata['points'] = int(offsets[-1])
+    metadata['height'] = 1
+    metadata['viewpoint'] = [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0]
+    return PointCloud(metadata, out[:offsets[-1]], validate=False)
+
+
 def make_xyz_point_cloud(xyz, metadata=None):
     """ Make a pointcloud object from xyz array.
     xyz array is cast to float32.
@@ -572,36 +1668,21 @@ def make_xyz_rgb_point_cloud(xyz_rgb, metadata=None):
 def encode_rgb_for_pcl(rgb):
     """ Encode bit-packed RGB for use with PCL.
 
-    :param rgb: Nx3 uint8 array with RGB values.
-    :rtype: Nx1 float32 array with bit-packed RGB, for PCL.
+    :param rgb: Nx3 uint8 array with RGB values, or Nx4 with RGBA values.
+    :rtype: N float32 array with bit-packed RGB, for PCL.
     """
-    assert(rgb.dtype == np.uint8)
-    assert(rgb.ndim == 2)
-    assert(rgb.shape[1] == 3)
-    rgb = rgb.astype(np.uint32)
-    rgb = np.array((rgb[:, 0] << 16) | (rgb[:, 1] << 8) | (rgb[:, 2] << 0),
-                   dtype=np.uint32)
-    rgb.dtype = np.float32
-    return rgb
+    return rgbutil.encode_rgb(rgb)
 
 
-def decode_rgb_from_pcl(rgb):
+def decode_rgb_from_pcl(rgb, alpha=False, copy=True):
     """ Decode the bit-packed RGBs used by PCL.
 
     :param rgb: An Nx1 array.
-    :rtype: Nx3 uint8 array with one column per color.
+    :param alpha: Also decode the alpha channel.
+    :param copy: If False, return a view into rgb instead (without alpha).
+    :rtype: Nx3 (or Nx4 with alpha) uint8 array with one column per color.
     """
-
-    rgb = rgb.copy()
-    rgb.dtype = np.uint32
-    r = np.asarray((rgb >> 16) & 255, dtype=np.uint8)
-    g = np.asarray((rgb >> 8) & 255, dtype=np.uint8)
-    b = np.asarray(rgb & 255, dtype=np.uint8)
-    rgb_arr = np.zeros((len(rgb), 3), dtype=np.uint8)
-    rgb_arr[:, 0] = r
-    rgb_arr[:, 1] = g
-    rgb_arr[:, 2] = b
-    return rgb_arr
+    return rgbutil.decode_rgb(rgb, alpha=alpha, copy=copy)
 
 
 def make_xyz_label_point_cloud(xyzl, label_type='f'):
@@ -638,11 +1719,28 @@ def make_xyz_label_point_cloud(xyzl, label_type='f'):
 class PointCloud(object):
     """ Wrapper for point cloud data.
 
+    The metadata and data are checked for consistency on construction.
+    Code that builds clouds from already checked clouds can skip this with
+    ``validate=False``. metadata may also be a ``PCDHeader``, which is
+    validated when it is built, so then only the data is checked; this
+    makes building many clouds with the same layout cheap.
+
     The variable members of this class parallel the ones used by
     the PCD metadata (and similar to PCL and ROS PointCloud2 messages),
 
     ``pc_data`` holds the actual data as a structured numpy array.
 
+    Alternatively the data can be stored column-oriented, as a dict of
+    contiguous per-field arrays, by passing such a dict as ``pc_data`` (or
+    calling ``to_columnar``). ``columns`` then gives direct access to these
+    arrays, which stay the storage of the cloud. ``pc_data`` is then a
+    read-only structured copy of them, built on first access and kept
+    until a column is replaced in ``columns`` (or ``invalidate_pc_data``
+    is called after writing to the columns in place). Operations that read
+    ``pc_data``, e.g. ``cat_point_clouds``, ``save_txt`` or ``to_msg``,
+    thus don't convert the cloud; ``to_interleaved`` switches back to a
+    writable structured array.
+
     The other relevant metadata variables are:
 
     - ``version``: Version, usually .7
@@ -664,11 +1762,178 @@ class PointCloud(object):
     for more information.
     """
 
-    def __init__(self, metadata, pc_data):
-        self.metadata_keys = metadata.keys()
+    def __init__(self, metadata, pc_data, validate=True):
+        header = None
+        if isinstance(metadata, PCDHeader):
+            header = metadata
+            metadata = header.to_metadata()
+        self.metadata_keys = list(metadata.keys())
         self.__dict__.update(metadata)
         self.pc_data = pc_data
-        self.check_sanity()
+        self._header = header
+        if validate:
+            if header is None:
+                self.check_sanity()
+            else:
+                # the header was validated when it was built
+                self._check_data()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'pc_data' or name in PCDHeader.members:
+            # the cached header no longer matches
+            object.__setattr__(self, '_header', None)
+
+    @property
+    def pc_data(self):
+        if self._columns is None:
+            return self._pc_data
+        columns = list(self._columns.values())
+        if self._pc_data is None or len(columns) != len(self._built_from) \
+                or any(c is not b for c, b in zip(columns, self._built_from)):
+            # build a read-only structured array from the columns
+            dtype = np.dtype([(n, c.dtype) for n, c in self._columns.items()])
+            pc_data = np.empty(self._num_points(), dtype=dtype)
+            for name, column in self._columns.items():
+                pc_data[name] = column
+            pc_data.flags.writeable = False
+            self._pc_data = pc_data
+            self._built_from = columns
+        return self._pc_data
+
+    @pc_data.setter
+    def pc_data(self, pc_data):
+        if isinstance(pc_data, dict):
+            names = _build_dtype(self.get_metadata()).names
+            missing = [n for n in names if n not in pc_data]
+            if missing:
+                raise ValueError('missing columns: %s' % ' '.join(missing))
+            self._columns = OrderedDict(
+                (n, np.ascontiguousarray(pc_data[n])) for n in names)
+            self._pc_data = None
+        else:
+            self._pc_data = pc_data
+            self._columns = None
+        self._built_from = []
+        self._index = None
+
+    @property
+    def is_columnar(self):
+        return self._columns is not None
+
+    @property
+    def columns(self):
+        """ dict of per-field arrays, in field order.
+
+        These are the contiguous column arrays if the cloud is columnar,
+        and views into ``pc_data`` otherwise.
+        """
+        if self._columns is not None:
+            return self._columns
+        return OrderedDict((n, self._pc_data[n])
+                           for n in self._pc_data.dtype.names)
+
+    def to_columnar(self):
+        """ Switch to column-oriented storage, in place.
+        """
+        if self._columns is None:
+            self.pc_data = dict(self.columns)
+
+    def to_interleaved(self):
+        """ Switch back to a writable structured ``pc_data``, in place.
+        """
+        if self._columns is not None:
+            self.pc_data = self.pc_data.copy()
+
+    def invalidate_pc_data(self):
+        """ Drop the ``pc_data`` built from the columns of a columnar cloud,
+        e.g. after the columns were written to in place. It is rebuilt on
+        the next access.
+        """
+        if self._columns is not None:
+            self._pc_data = None
+
+    @property
+    def index(self):
+        """ ``spatial.VoxelIndex`` of the xyz of the points, built with the
+        default cell size on first use (see ``build_index``). Indices
+        returned by its queries are point numbers.
+
+        It is dropped when the data is replaced, or when x, y or z are
+        changed by ``update_field`` or the ``sautil`` transforms. Changes
+        made in place to the coordinates, e.g. ``pc.pc_data['x'] += 1`` or
+        ``sautil.transform_cloud_array(T, pc.pc_data)``, aren't noticed;
+        call ``invalidate_index`` after them.
+        """
+        if self._index is None:
+            self.build_index()
+        return self._index
+
+    @property
+    def rgb(self):
+        """ Nx3 uint8 view of the colors in the packed ``rgb`` (or
+        ``rgba``) field, see ``rgbutil.rgb_view``. Writing to it changes
+        the cloud.
+        """
+        return rgbutil.rgb_view(self.columns[self._rgb_field()])
+
+    @property
+    def alpha(self):
+        """ N uint8 view of the alpha channel of the packed colors. """
+        return rgbutil.alpha_view(self.columns[self._rgb_field()])
+
+    def _rgb_field(self):
+        for name in ('rgb', 'rgba'):
+            if name in self.fields:
+                return name
+        raise ValueError('point cloud has no rgb field')
+
+    def build_index(self, cell_size=None):
+        """ Build and cache the spatial index, with cells of cell_size
+        (see ``spatial.VoxelIndex``), and return it.
+        """
+        self._index = spatial.VoxelIndex(self._xyz(), cell_size)
+        return self._index
+
+    def invalidate_index(self):
+        """ Drop the spatial index, e.g. after the coordinates were changed
+        in place. It is rebuilt on the next use of ``index``.
+        """
+        self._index = None
+
+    def save_index(self, fname):
+        """ Save the spatial index next to the pcd file fname.
+        """
+        self.index.save(spatial.index_path(fname))
+
+    def load_index(self, fname):
+        """ Load the spatial index saved next to the pcd file fname, so it
+        needn't be rebuilt.
+        """
+        self._index = spatial.VoxelIndex.load(spatial.index_path(fname),
+                                              self._xyz())
+
+    def _xyz(self):
+        columns = self.columns
+        return np.stack([columns[name].reshape(-1)
+                         for name in ('x', 'y', 'z')], -1)
+
+    def _num_points(self):
+        if self._columns is None:
+            return len(self._pc_data)
+        return len(next(iter(self._columns.values())))
+
+    @property
+    def header(self):
+        """ PCDHeader with the current metadata.
+
+        It is cached until metadata or ``pc_data`` are assigned to; changes
+        made in place, e.g. to the ``fields`` list, aren't noticed.
+        """
+        if self._header is None:
+            self._header = PCDHeader.from_metadata(
+                dict((k, getattr(self, k)) for k in PCDHeader.members))
+        return self._header
 
     def get_metadata(self):
         """ returns copy of metadata """
@@ -679,30 +1944,45 @@ class PointCloud(object):
 
     def check_sanity(self):
         # pdb.set_trace()
-        md = self.get_metadata()
+        # only reads the metadata, so no need for get_metadata copies
+        md = dict((k, getattr(self, k)) for k in self.metadata_keys)
         assert(_metadata_is_consistent(md))
-        assert(len(self.pc_data) == self.points)
+        self._check_data()
         assert(self.width*self.height == self.points)
         assert(len(self.fields) == len(self.count))
         assert(len(self.fields) == len(self.type))
 
+    def _check_data(self):
+        assert(self._num_points() == self.points)
+        if self._columns is not None:
+            assert(all(len(c) == self.points
+                       for c in self._columns.values()))
+
     def save(self, fname):
         self.save_pcd(fname, 'ascii')
 
-    def save_pcd(self, fname, compression=None, **kwargs):
+    def save_pcd(self, fname, compression=None, fmt=None, **kwargs):
         if 'data_compression' in kwargs:
             warnings.warn('data_compression keyword is deprecated for'
                           ' compression')
             compression = kwargs['data_compression']
-        with open(fname, 'w') as f:
-            point_cloud_to_fileobj(self, f, compression)
+        with open(fname, 'wb') as f:
+            point_cloud_to_fileobj(self, f, compression, fmt)
 
-    def save_pcd_to_fileobj(self, fileobj, compression=None, **kwargs):
+    def save_pcd_to_fileobj(self, fileobj, compression=None, fmt=None,
+                            **kwargs):
         if 'data_compression' in kwargs:
             warnings.warn('data_compression keyword is deprecated for'
                           ' compression')
             compression = kwargs['data_compression']
-        point_cloud_to_fileobj(self, fileobj, compression)
+        point_cloud_to_fileobj(self, fileobj, compression, fmt)
+
+    def asave(self, fname, compression=None, **kwargs):
+        """ Coroutine to save the cloud without blocking the event loop,
+        see ``pypcd.aio.asave``. Needs python 3.5 or newer.
+        """
+        from .aio import asave
+        return asave(self, fname, compression, **kwargs)
 
     def save_pcd_to_buffer(self, compression=None, **kwargs):
         if 'data_compression' in kwargs:
@@ -711,8 +1991,8 @@ class PointCloud(object):
             compression = kwargs['data_compression']
         return point_cloud_to_buffer(self, compression)
 
-    def save_txt(self, fname):
-        save_txt(self, fname)
+    def save_txt(self, fname, **kwargs):
+        save_txt(self, fname, **kwargs)
 
     def save_xyz_label(self, fname, **kwargs):
         save_xyz_label(self, fname, **kwargs)
@@ -720,10 +2000,28 @@ class PointCloud(object):
     def save_xyz_intensity_label(self, fname, **kwargs):
         save_xyz_intensity_label(self, fname, **kwargs)
 
+    def export_columns(self, fname, fields, **kwargs):
+        export_columns(self, fname, fields, **kwargs)
+
+    def voxel_downsample(self, leaf_size, reduce='centroid', **kwargs):
+        """ New PointCloud downsampled on a voxel grid of leaf_size,
+        see ``sautil.voxel_downsample``.
+        """
+        pc_data = sautil.voxel_downsample(self.pc_data, leaf_size, reduce,
+                                          **kwargs)
+        metadata = self.get_metadata()
+        metadata['width'] = metadata['points'] = len(pc_data)
+        metadata['height'] = 1
+        return PointCloud(metadata, pc_data, validate=False)
+
     def copy(self):
-        new_pc_data = np.copy(self.pc_data)
+        if self.is_columnar:
+            new_pc_data = dict((n, np.copy(c))
+                               for n, c in self._columns.items())
+        else:
+            new_pc_data = np.copy(self.pc_data)
         new_metadata = self.get_metadata()
-        return PointCloud(new_metadata, new_pc_data)
+        return PointCloud(new_metadata, new_pc_data, validate=False)
 
     def to_msg(self):
         if not HAS_SENSOR_MSGS:
@@ -732,40 +2030,26 @@ class PointCloud(object):
         return numpy_pc2.array_to_pointcloud2(self.pc_data)
 
     @staticmethod
-    def from_path(fname):
-        return point_cloud_from_path(fname)
+    def from_path(fname, mmap=False, fields=None, columnar=False):
+        return point_cloud_from_path(fname, mmap=mmap, fields=fields,
+                                     columnar=columnar)
 
     @staticmethod
-    def from_fileobj(fileobj):
-        return point_cloud_from_fileobj(fileobj)
+    def from_fileobj(fileobj, fields=None, columnar=False):
+        return point_cloud_from_fileobj(fileobj, fields=fields,
+                                        columnar=columnar)
 
     @staticmethod
-    def from_buffer(buf):
-        return point_cloud_from_buffer(buf)
+    def from_buffer(buf, fields=None, columnar=False, copy=True):
+        return point_cloud_from_buffer(buf, fields=fields, columnar=columnar,
+                                       copy=copy)
 
     @staticmethod
     def from_array(arr):
         """ create a PointCloud object from an array.
         """
         pc_data = arr.copy()
-        md = {'version': .7,
-              'fields': [],
-              'size': [],
-              'count': [],
-              'width': 0,
-              'height': 1,
-              'viewpoint': [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0],
-              'points': 0,
-              'type': [],
-              'data': 'binary_compressed'}
-        md['fields'] = pc_data.dtype.names
-        for field in md['fields']:
-            type_, size_ =\
-                numpy_type_to_pcd_type[pc_data.dtype.fields[field][0]]
-            md['type'].append(type_)
-            md['size'].append(size_)
-            # TODO handle multicount
-            md['count'].append(1)
+        md = _metadata_from_dtype(pc_data.dtype)
         md['width'] = len(pc_data)
         md['points'] = len(pc_data)
         pc = PointCloud(md, pc_data)
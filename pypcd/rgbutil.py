@@ -0,0 +1,76 @@
+""" Utilities for the packed colors used by PCL.
+
+PCL packs colors into a single 4-byte field, usually called ``rgb`` (a
+float32) or ``rgba`` (a uint32), whose value as an uint32 is 0xAARRGGBB.
+The functions here get at the channels through uint8 views of that field,
+taking its byte order into account, rather than with shifts and masks on
+uint32 copies.
+"""
+
+import sys
+
+import numpy as np
+
+
+def _channel_bytes(packed):
+    """ (N, 4) uint8 view of the bytes of the packed 4-byte values, which
+    may be strided, e.g. a field of a structured array. Also returns
+    whether the values are little-endian.
+    """
+    if packed.dtype.itemsize != 4:
+        raise ValueError('packed colors must have 4 bytes, not %s' %
+                         packed.dtype)
+    packed = packed.reshape(-1)
+    order = packed.dtype.byteorder
+    little = order == '<' or (order in '=|' and sys.byteorder == 'little')
+    return packed.getfield(np.dtype((np.uint8, 4)), 0), little
+
+
+def rgb_view(packed):
+    """ (N, 3) uint8 view of the r, g and b channels of packed colors,
+    e.g. ``pc_data['rgb']``. Writing to it changes packed.
+    """
+    channels, little = _channel_bytes(packed)
+    # bytes in memory are b g r a if little-endian, a r g b if big-endian
+    if little:
+        return channels[:, 2::-1]
+    return channels[:, 1:]
+
+
+def alpha_view(packed):
+    """ (N,) uint8 view of the alpha channel of packed colors.
+    """
+    channels, little = _channel_bytes(packed)
+    return channels[:, 3] if little else channels[:, 0]
+
+
+def encode_rgb(rgb, dtype=np.float32):
+    """ Pack an Nx3 (or Nx4 with alpha) uint8 array into an array of
+    dtype. Without alpha it is 0.
+    """
+    assert(rgb.dtype == np.uint8)
+    assert(rgb.ndim == 2)
+    assert(rgb.shape[1] in (3, 4))
+    packed = np.zeros(len(rgb), dtype=dtype)
+    rgb_view(packed)[:] = rgb[:, :3]
+    if rgb.shape[1] == 4:
+        alpha_view(packed)[:] = rgb[:, 3]
+    return packed
+
+
+def decode_rgb(packed, alpha=False, copy=True):
+    """ Unpack colors into an Nx3 uint8 array, or Nx4 if alpha is True.
+
+    If copy is False the result is ``rgb_view(packed)`` itself; that
+    can't include alpha.
+    """
+    if not copy:
+        if alpha:
+            raise ValueError('rgba can not be viewed without a copy')
+        return rgb_view(packed)
+    view = rgb_view(packed)
+    rgb = np.empty((len(view), 4 if alpha else 3), dtype=np.uint8)
+    rgb[:, :3] = view
+    if alpha:
+        rgb[:, 3] = alpha_view(packed)
+    return rgb
@@ -5,42 +5,168 @@ such as the ``pc_data`` in ``PointCloud`` objects.
 
 import numpy as np
 
+from . import rgbutil
+
 
 def transform_xyz(T_a_b, xyz):
     """ Transforms an Nx3 array xyz in frame a to frame b
     T_a_b is a 4x4 matrix s.t. xyz_b = T_a_b * xyz_a
     conversely, T_a_b is the pose a in the frame b
     """
-    # xyz in frame a, homogeneous
-    xyz1_a = np.vstack([xyz.T, np.ones((1, xyz.shape[0]))])
-    # xyz in b frame
-    xyz1_b = np.dot(T_a_b, xyz1_a)
-    xyz_b = np.ascontiguousarray((xyz1_b[:3]).T)
+    T_a_b = np.asarray(T_a_b, dtype=np.float64)
+    xyz_b = np.dot(xyz, T_a_b[:3, :3].T)
+    xyz_b += T_a_b[:3, 3]
     return xyz_b
 
 
-def transform_cloud_array(T_a_b, pc_data):
-    """ transforms structured array. looks for xyz and xyz_origin """
-    xyz = get_xyz_array(pc_data, dtype=pc_data.dtype[0])
-    xyz_b = transform_xyz(T_a_b, xyz)
-    pc_data['x'] = xyz_b[:, 0]
-    pc_data['y'] = xyz_b[:, 1]
-    pc_data['z'] = xyz_b[:, 2]
-    if 'x_origin' in pc_data:
-        xyz_origin = get_xyz_viewpoint_array(pc_data, dtype=pc_data.dtype[0])
-        xyz_origin_b = transform_xyz(T_a_b, xyz_origin)
-        pc_data['x_origin'] = xyz_origin_b[:, 0]
-        pc_data['y_origin'] = xyz_origin_b[:, 1]
-        pc_data['z_origin'] = xyz_origin_b[:, 2]
+# points transformed at a time by transform_cloud_array
+TRANSFORM_BLOCK_POINTS = 1 << 16
+
+
+def _field_names(pc_data):
+    if hasattr(pc_data, 'dtype'):
+        return pc_data.dtype.names or ()
+    return tuple(pc_data.keys())
+
+
+def _transform_fields(T_a_b, pc_data, names, block_points):
+    """ Apply T_a_b in place to the points in fields names of pc_data, a
+    structured array or dict of columns, block_points at a time. Only
+    two block-sized buffers are allocated.
+    """
+    R = np.ascontiguousarray(T_a_b[:3, :3].T)
+    t = T_a_b[:3, 3]
+    cols = [pc_data[name].reshape(-1) for name in names]
+    n = len(cols[0])
+    xyz = np.empty((min(n, block_points), 3))
+    xyz_b = np.empty_like(xyz)
+    for start in range(0, n, block_points):
+        stop = min(start+block_points, n)
+        a, b = xyz[:stop-start], xyz_b[:stop-start]
+        for i, col in enumerate(cols):
+            a[:, i] = col[start:stop]
+        np.dot(a, R, out=b)
+        b += t
+        for i, col in enumerate(cols):
+            col[start:stop] = b[:, i]
+
+
+def _quaternion_to_rotation(q):
+    w, x, y, z = q / np.linalg.norm(q)
+    return np.array([[1-2*(y*y+z*z), 2*(x*y-z*w), 2*(x*z+y*w)],
+                     [2*(x*y+z*w), 1-2*(x*x+z*z), 2*(y*z-x*w)],
+                     [2*(x*z-y*w), 2*(y*z+x*w), 1-2*(x*x+y*y)]])
+
+
+def _rotation_to_quaternion(R):
+    # the largest of the four candidates for numerical stability
+    trace = np.trace(R)
+    i = np.argmax([trace, R[0, 0], R[1, 1], R[2, 2]])
+    if i == 0:
+        s = 2*np.sqrt(1 + trace)
+        q = [s/4, (R[2, 1]-R[1, 2])/s, (R[0, 2]-R[2, 0])/s,
+             (R[1, 0]-R[0, 1])/s]
+    elif i == 1:
+        s = 2*np.sqrt(1 + R[0, 0] - R[1, 1] - R[2, 2])
+        q = [(R[2, 1]-R[1, 2])/s, s/4, (R[0, 1]+R[1, 0])/s,
+             (R[0, 2]+R[2, 0])/s]
+    elif i == 2:
+        s = 2*np.sqrt(1 + R[1, 1] - R[0, 0] - R[2, 2])
+        q = [(R[0, 2]-R[2, 0])/s, (R[0, 1]+R[1, 0])/s, s/4,
+             (R[1, 2]+R[2, 1])/s]
+    else:
+        s = 2*np.sqrt(1 + R[2, 2] - R[0, 0] - R[1, 1])
+        q = [(R[1, 0]-R[0, 1])/s, (R[0, 2]+R[2, 0])/s,
+             (R[1, 2]+R[2, 1])/s, s/4]
+    return np.array(q)
+
+
+def transform_viewpoint(T_a_b, viewpoint):
+    """ Transforms a pcd viewpoint (x y z qw qx qy qz) in frame a to
+    frame b. Returns a new list.
+    """
+    T_a_b = np.asarray(T_a_b, dtype=np.float64)
+    viewpoint = np.asarray(viewpoint, dtype=np.float64)
+    xyz = np.dot(T_a_b[:3, :3], viewpoint[:3]) + T_a_b[:3, 3]
+    R = np.dot(T_a_b[:3, :3], _quaternion_to_rotation(viewpoint[3:]))
+    return [float(v) for v in np.concatenate([xyz,
+                                              _rotation_to_quaternion(R)])]
+
+
+def transform_cloud_array(T_a_b, pc_data, block_points=None):
+    """ transforms structured array in place. looks for xyz and
+    xyz_origin.
+
+    The points are transformed a block at a time directly in their fields,
+    without full-size temporaries.
+
+    pc_data may also be a PointCloud, whose viewpoint is then transformed
+    too and whose spatial index is dropped.
+    """
+    if block_points is None:
+        block_points = TRANSFORM_BLOCK_POINTS
+    T_a_b = np.asarray(T_a_b, dtype=np.float64)
+    if hasattr(pc_data, 'invalidate_index'):
+        pc = pc_data
+        columns = pc.columns
+        if pc.is_columnar:
+            # columns may be read-only views
+            for name in columns:
+                if not columns[name].flags.writeable:
+                    columns[name] = columns[name].copy()
+        transform_cloud_array(T_a_b, columns, block_points)
+        pc.viewpoint = transform_viewpoint(T_a_b, pc.viewpoint)
+        pc.invalidate_index()
+        pc.invalidate_pc_data()
+        return pc
+    names = _field_names(pc_data)
+    _transform_fields(T_a_b, pc_data, ('x', 'y', 'z'), block_points)
+    if 'x_origin' in names:
+        _transform_fields(T_a_b, pc_data,
+                          ('x_origin', 'y_origin', 'z_origin'), block_points)
     return pc_data
 
 
+def transform_cloud_arrays(T_a_bs, pc_datas, workers=1, block_points=None):
+    """ ``transform_cloud_array`` for many clouds, each by its own pose.
+
+    T_a_bs is a sequence (or Kx4x4 array) of transforms and pc_datas a
+    sequence of structured arrays or PointClouds of the same length. With
+    workers > 1 the clouds are transformed in a pool of threads; numpy
+    releases the GIL in the block products.
+    """
+    if len(T_a_bs) != len(pc_datas):
+        raise ValueError('got %d transforms for %d clouds' %
+                         (len(T_a_bs), len(pc_datas)))
+
+    def transform(args):
+        return transform_cloud_array(args[0], args[1], block_points)
+    if workers <= 1:
+        return [transform(args) for args in zip(T_a_bs, pc_datas)]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        result = pool.map(transform, list(zip(T_a_bs, pc_datas)))
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return result
+
+
 def flip_around_x(pc_data):
-    """ flip a structured array around x, in place"""
+    """ flip a structured array (or PointCloud) around x, in place"""
+    if hasattr(pc_data, 'invalidate_index'):
+        transform_cloud_array(np.diag([1., -1., -1., 1.]), pc_data)
+        return
+    names = _field_names(pc_data)
     pc_data['y'] = -pc_data['y']
     pc_data['z'] = -pc_data['z']
 
-    if 'x_origin' in pc_data:
+    if 'x_origin' in names:
         pc_data['y_origin'] = -pc_data['y_origin']
         pc_data['z_origin'] = -pc_data['z_origin']
 
@@ -76,3 +202,121 @@ def get_xyzl_array(pc_data, dtype=np.float32):
     xyzl[:, 2] = pc_data['z']
     xyzl[:, 3] = pc_data['label']
     return xyzl
+
+
+def _voxel_keys(pc_data, leaf, chunk_points):
+    """ int64 voxel key of each point of pc_data, with leaf the (3,) voxel
+    size. Points with non-finite coordinates get key -1.
+    """
+    lo = np.empty(3, dtype=np.int64)
+    ext = np.empty(3, dtype=np.int64)
+    for a, name in enumerate('xyz'):
+        col = pc_data[name]
+        finite = col[np.isfinite(col)]
+        if len(finite) == 0:
+            return np.full(len(pc_data), -1, dtype=np.int64)
+        # floor is monotonic, so the extremes of the points give the range
+        lo[a] = np.floor(finite.min() / leaf[a])
+        ext[a] = np.floor(finite.max() / leaf[a]) - lo[a] + 1
+    if float(ext[0])*float(ext[1])*float(ext[2]) >= 2**62:
+        raise ValueError('leaf_size is too small for the extent of the cloud')
+    keys = np.zeros(len(pc_data), dtype=np.int64)
+    for start in range(0, len(pc_data), chunk_points):
+        stop = start + chunk_points
+        valid = np.ones(len(keys[start:stop]), dtype=bool)
+        for a, name in enumerate('xyz'):
+            ijk = np.floor(pc_data[name][start:stop] / leaf[a])
+            valid &= np.isfinite(ijk)
+            ijk[~valid] = lo[a]
+            keys[start:stop] *= ext[a]
+            keys[start:stop] += ijk.astype(np.int64) - lo[a]
+        keys[start:stop][~valid] = -1
+    return keys
+
+
+def _group_keys(keys):
+    """ Like ``np.unique(keys, return_index=True, return_inverse=True)``.
+
+    The index of the first key of each group is found with a reduction
+    after an unstable sort, which is several times faster than the stable
+    sort np.unique needs for it.
+    """
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    new_group = np.empty(len(keys), dtype=bool)
+    new_group[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=new_group[1:])
+    starts = np.flatnonzero(new_group)
+    if len(starts) == 0:
+        first = np.empty(0, dtype=order.dtype)
+    else:
+        first = np.minimum.reduceat(order, starts)
+    inverse = np.empty(len(keys), dtype=np.intp)
+    inverse[order] = np.cumsum(new_group) - 1
+    return sorted_keys[starts], first, inverse
+
+
+def voxel_downsample(pc_data, leaf_size, reduce='centroid',
+                     chunk_points=1 << 22):
+    """ Downsample structured array pc_data on a voxel grid.
+
+    leaf_size is the voxel size, a scalar or one per axis. Each voxel with
+    points becomes one point, and points with non-finite xyz are dropped.
+    reduce is
+
+    - ``'first'``: the first point of each voxel.
+    - ``'centroid'``: the mean xyz of the points of each voxel, other
+      fields from its first point.
+    - ``'mean_all_fields'``: the mean of every field; integer fields are
+      rounded. Packed ``rgb`` and ``rgba`` fields are averaged per color
+      channel.
+
+    The points are grouped with a single sort of their voxel keys; the
+    keys and means are computed chunk_points at a time, bounding the size
+    of temporaries. The result is a new array, in voxel key order.
+    """
+    if reduce not in ('centroid', 'first', 'mean_all_fields'):
+        raise ValueError('unknown reduce %s' % reduce)
+    pc_data = pc_data.reshape(-1)
+    leaf = np.empty(3, dtype=np.float64)
+    leaf[:] = leaf_size
+    if not (leaf > 0).all():
+        raise ValueError('leaf_size must be positive')
+    keys = _voxel_keys(pc_data, leaf, chunk_points)
+    uniq, first, inverse = _group_keys(keys)
+    del keys
+    # non-finite points, if any, are the group of key -1, which sorts first
+    skip = 1 if len(uniq) and uniq[0] < 0 else 0
+    out = pc_data[first[skip:]]
+    if reduce == 'first':
+        return out
+    if reduce == 'centroid':
+        names = ('x', 'y', 'z')
+    else:
+        names = pc_data.dtype.names
+    voxels = len(first)
+    counts = np.bincount(inverse, minlength=voxels)[skip:]
+    cols = []
+    for name in names:
+        if name in ('rgb', 'rgba') and pc_data.dtype[name].itemsize == 4:
+            # average the channels, not the packed values
+            cols.append((rgbutil.rgb_view(pc_data[name]),
+                         rgbutil.rgb_view(out[name])))
+            cols.append((rgbutil.alpha_view(pc_data[name])[:, None],
+                         rgbutil.alpha_view(out[name])[:, None]))
+        else:
+            cols.append((pc_data[name].reshape(len(pc_data), -1),
+                         out[name].reshape(len(out), -1)))
+    for col, out_col in cols:
+        for j in range(col.shape[1]):
+            sums = np.zeros(voxels)
+            for start in range(0, len(pc_data), chunk_points):
+                stop = start + chunk_points
+                sums += np.bincount(inverse[start:stop],
+                                    weights=col[start:stop, j],
+                                    minlength=voxels)
+            mean = sums[skip:] / counts
+            if out_col.dtype.kind in 'iub':
+                mean = np.round(mean)
+            out_col[:, j] = mean
+    return out
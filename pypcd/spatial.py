@@ -0,0 +1,326 @@
+"""
+Spatial index for radius and nearest neighbor queries on point clouds.
+
+The index hashes points into a regular grid of cubic cells: the points are
+sorted by cell key, and a query gathers the points of the cells around it
+with a binary search of the occupied cell keys. Queries are processed in
+vectorized batches.
+"""
+
+import numpy as np
+
+__all__ = ['VoxelIndex', 'index_path']
+
+
+def index_path(fname):
+    """ Path of the saved index of the pcd file fname.
+    """
+    return fname + '.index.npz'
+
+
+class VoxelIndex(object):
+    """ Voxel hash index of the (N, 3) points xyz.
+
+    cell_size is the edge of the grid cells. Queries are fastest when it is
+    close to the typical query radius; by default it is chosen to give a
+    few points per occupied cell, which also suits clouds of surfaces,
+    whose points fill few of the cells of their bounding box. Points with
+    non-finite coordinates are not indexed.
+
+    The index keeps its own copy of the points, so it goes stale if the
+    points change; ``PointCloud.index`` takes care of this for clouds.
+    """
+
+    # max number of queries gathered at once
+    batch_size = 4096
+    # max number of candidate neighbors (or cells, while looking them up)
+    # gathered at once; queries are split further to stay under it
+    max_candidates = 1 << 22
+    # points per occupied cell aimed at by the default cell_size
+    points_per_cell = 4
+
+    def __init__(self, xyz, cell_size=None):
+        xyz = np.asarray(xyz)
+        order = np.flatnonzero(np.isfinite(xyz).all(1))
+        dtype = np.promote_types(xyz.dtype, np.float32)
+        finite = xyz[order].astype(dtype)
+        if cell_size is None:
+            cell_size = self._default_cell_size(finite)
+        self.cell_size = float(cell_size)
+        if len(finite):
+            self.lo = np.floor(finite.min(0) / self.cell_size).astype(np.int64)
+            hi = np.floor(finite.max(0) / self.cell_size).astype(np.int64)
+        else:
+            self.lo = hi = np.zeros(3, dtype=np.int64)
+        self.ext = hi - self.lo + 1
+        if float(self.ext[0])*float(self.ext[1])*float(self.ext[2]) >= 2**62:
+            raise ValueError('cell_size is too small for the extent of '
+                             'the points')
+        keys = self._keys(self._cells(finite))
+        sort = np.argsort(keys, kind='mergesort')
+        keys = keys[sort]
+        self.order = order[sort]
+        self.xyz = finite[sort]
+        self.cell_keys, self.cell_starts = self._cell_table(keys)
+
+    @classmethod
+    def _default_cell_size(cls, pts):
+        """ Cell size giving about ``points_per_cell`` points per occupied
+        cell.
+
+        The first guess assumes the points fill their bounding box. Where
+        they don't, e.g. for a surface, the number of occupied cells is
+        measured and the size refined assuming the occupied cells grow as
+        a power of 1/size, whose exponent is estimated on the way.
+        """
+        if not len(pts):
+            return 1.
+        lo = pts.min(0)
+        pts = pts - lo
+        extent = float(pts.max())
+        if not extent > 0:
+            return 1.
+        n = len(pts)
+        size = 2*extent / n**(1/3.)
+        occupied = cls._occupied_cells(pts, size)
+        dim = 2.
+        for _ in range(4):
+            if occupied*cls.points_per_cell*2 >= n:
+                break
+            new_size = size * (occupied*cls.points_per_cell /
+                               float(n))**(1/dim)
+            if (extent/new_size + 1)**3 >= 2**62:
+                break
+            new_occupied = cls._occupied_cells(pts, new_size)
+            if new_occupied > occupied:
+                dim = np.clip(np.log(new_occupied/float(occupied)) /
+                              np.log(size/new_size), 1., 3.)
+            size, occupied = new_size, new_occupied
+        return size
+
+    @staticmethod
+    def _occupied_cells(pts, size):
+        cells = np.floor(pts / size).astype(np.int64)
+        ext = cells.max(0) + 1
+        keys = (cells[:, 0]*ext[1] + cells[:, 1])*ext[2] + cells[:, 2]
+        keys.sort()
+        return 1 + np.count_nonzero(keys[1:] != keys[:-1])
+
+    @staticmethod
+    def _cell_table(keys):
+        new_cell = np.empty(len(keys), dtype=bool)
+        new_cell[:1] = True
+        np.not_equal(keys[1:], keys[:-1], out=new_cell[1:])
+        starts = np.flatnonzero(new_cell)
+        return keys[starts], np.append(starts, len(keys))
+
+    def __len__(self):
+        return len(self.order)
+
+    def _cells(self, pts):
+        return np.floor(pts / self.cell_size).astype(np.int64) - self.lo
+
+    def _keys(self, cells):
+        return (cells[..., 0]*self.ext[1] + cells[..., 1])*self.ext[2] + \
+            cells[..., 2]
+
+    def _candidates(self, pts, m):
+        """ Candidate neighbors of the (M, 3) points pts, those in the
+        cells at most m cells away along each axis.
+
+        Yields them for consecutive ranges of the queries, sized to keep
+        the candidates under ``max_candidates`` (a single query may exceed
+        it). For each range a:b it yields a, b and the query number (from
+        a) and sorted point position of each candidate, grouped by query.
+        If the cells cover all points these two are None instead, and all
+        points are candidates of each query.
+        """
+        span = np.arange(-m, m+1)
+        if len(span)**3 >= len(self.cell_keys):
+            # the cube covers more cells than are occupied; take all points
+            step = max(1, self.max_candidates // max(len(self.xyz), 1))
+            for a in range(0, len(pts), step):
+                yield a, min(a+step, len(pts)), None, None
+            return
+        offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'),
+                           -1).reshape(-1, 3)
+        step = max(1, self.max_candidates // len(offsets))
+        for a0 in range(0, len(pts), step):
+            pts_s = pts[a0:a0+step]
+            cells = self._cells(pts_s)[:, None, :] + offsets[None, :, :]
+            valid = ((cells >= 0) & (cells < self.ext)).all(-1)
+            keys = np.where(valid, self._keys(cells), -1).reshape(-1)
+            ix = np.searchsorted(self.cell_keys, keys)
+            ix[ix == len(self.cell_keys)] = 0
+            found = self.cell_keys[ix] == keys
+            starts = self.cell_starts[ix][found]
+            counts = self.cell_starts[ix+1][found] - starts
+            cell_q = np.nonzero(found.reshape(valid.shape))[0]
+            # split the queries where the candidates exceed the budget
+            totals = np.cumsum(np.bincount(cell_q, counts,
+                                           minlength=len(pts_s)))
+            a = 0
+            while a < len(pts_s):
+                base = totals[a-1] if a else 0
+                b = max(a+1, np.searchsorted(totals, base+self.max_candidates,
+                                             'right'))
+                lo, hi = np.searchsorted(cell_q, [a, b])
+                c_starts, c_counts = starts[lo:hi], counts[lo:hi]
+                cand_q = np.repeat(cell_q[lo:hi] - a, c_counts)
+                # positions start, start+1, ... for each found cell
+                first = np.cumsum(c_counts) - c_counts
+                cand_pos = np.arange(c_counts.sum()) + \
+                    np.repeat(c_starts - first, c_counts)
+                yield a0+a, a0+b, cand_q, cand_pos
+                a = b
+
+    def _dist2(self, pts, cand_q, cand_pos):
+        diff = self.xyz[cand_pos] - pts[cand_q]
+        return np.einsum('ij,ij->i', diff, diff)
+
+    def _dist2_all(self, pts):
+        """ (M, N) squared distances of pts to all points. """
+        diff = self.xyz[None, :, :] - pts[:, None, :]
+        return np.einsum('ijk,ijk->ij', diff, diff)
+
+    def _batches(self, pts):
+        pts = np.asarray(pts, dtype=self.xyz.dtype).reshape(-1, 3)
+        for start in range(0, len(pts), self.batch_size):
+            yield pts[start:start+self.batch_size]
+
+    def query_radius(self, pts, r, return_distance=False, sort_results=False):
+        """ Points within distance r of each of the (M, 3) points pts.
+
+        Returns a list of M arrays with the indices (into the indexed
+        points) of the neighbors of each point, and if return_distance is
+        True also a list with their distances. If sort_results is True the
+        neighbors are sorted by distance.
+        """
+        m = int(np.ceil(r / self.cell_size))
+        indices, distances = [], []
+        for pts_b in self._batches(pts):
+            for a, b, cand_q, cand_pos in self._candidates(pts_b, m):
+                if cand_q is None:
+                    d2 = self._dist2_all(pts_b[a:b])
+                    cand_q, cand_pos = np.nonzero(d2 <= r*r)
+                    d2 = d2[cand_q, cand_pos]
+                else:
+                    d2 = self._dist2(pts_b[a:b], cand_q, cand_pos)
+                    inside = d2 <= r*r
+                    cand_q, cand_pos, d2 = cand_q[inside], cand_pos[inside], \
+                        d2[inside]
+                if sort_results:
+                    sort = np.lexsort((d2, cand_q))
+                    cand_q, cand_pos, d2 = cand_q[sort], cand_pos[sort], \
+                        d2[sort]
+                bounds = np.searchsorted(cand_q, np.arange(1, b-a))
+                indices.extend(np.split(self.order[cand_pos], bounds))
+                if return_distance:
+                    distances.extend(np.split(np.sqrt(d2), bounds))
+        if return_distance:
+            return indices, distances
+        return indices
+
+    def knn(self, pts, k):
+        """ The k nearest neighbors of each of the (M, 3) points pts.
+
+        Returns (M, k) arrays of the distances and indices (into the
+        indexed points) of the neighbors, sorted by distance.
+
+        The cells around each point are searched in growing cubes until the
+        k-th nearest candidate is closer than the edge of the cube.
+        """
+        if k > len(self):
+            raise ValueError('k=%d is more than the %d indexed points' %
+                             (k, len(self)))
+        dist = []
+        idx = []
+        # a cube of (2m+1)^3 cells expected to hold k points
+        per_cell = len(self) / float(max(len(self.cell_keys), 1))
+        m0 = max(1, int(np.ceil(((k / per_cell)**(1/3.) - 1)/2)))
+        for pts_b in self._batches(pts):
+            dist_b = np.empty((len(pts_b), k), dtype=self.xyz.dtype)
+            pos_b = np.empty((len(pts_b), k), dtype=np.intp)
+            pending = np.arange(len(pts_b))
+            m = m0
+            while len(pending):
+                left = np.ones(len(pending), dtype=bool)
+                for a, b, cand_q, cand_pos in \
+                        self._candidates(pts_b[pending], m):
+                    sub = pending[a:b]
+                    if cand_q is None:
+                        # all points are candidates, so the k nearest are
+                        d2 = self._dist2_all(pts_b[sub])
+                        pos = np.argpartition(d2, k-1, 1)[:, :k]
+                        d2 = np.take_along_axis(d2, pos, 1)
+                        sort = np.argsort(d2, 1)
+                        dist_b[sub] = np.sqrt(np.take_along_axis(d2, sort, 1))
+                        pos_b[sub] = np.take_along_axis(pos, sort, 1)
+                        left[a:b] = False
+                        continue
+                    d2 = self._dist2(pts_b[sub], cand_q, cand_pos)
+                    sort = np.lexsort((d2, cand_q))
+                    cand_q, cand_pos, d2 = cand_q[sort], cand_pos[sort], \
+                        d2[sort]
+                    starts = np.searchsorted(cand_q, np.arange(len(sub)))
+                    counts = np.diff(np.append(starts, len(cand_q)))
+                    # exact if the k-th candidate is within the searched cube
+                    kth = np.full(len(sub), np.inf)
+                    has_k = counts >= k
+                    kth[has_k] = d2[starts[has_k] + k-1]
+                    radius = m*self.cell_size
+                    done = has_k & (kth <= radius*radius)
+                    sel = (starts[done][:, None] + np.arange(k)).reshape(-1)
+                    dist_b[sub[done]] = np.sqrt(d2[sel]).reshape(-1, k)
+                    pos_b[sub[done]] = cand_pos[sel].reshape(-1, k)
+                    left[a:b] = ~done
+                pending = pending[left]
+                m *= 2
+            dist.append(dist_b)
+            idx.append(self.order[pos_b])
+        if not dist:
+            return (np.empty((0, k), dtype=self.xyz.dtype),
+                    np.empty((0, k), dtype=np.intp))
+        return np.concatenate(dist), np.concatenate(idx)
+
+    def save(self, fname):
+        """ Save the index to fname, an .npz file. The points are not
+        saved, they have to be passed to ``load``.
+        """
+        with open(fname, 'wb') as f:
+            np.savez(f, cell_size=self.cell_size, lo=self.lo, ext=self.ext,
+                     order=self.order, cell_keys=self.cell_keys,
+                     cell_starts=self.cell_starts)
+
+    @classmethod
+    def load(cls, fname, xyz):
+        """ Load an index saved with ``save`` for the (N, 3) points xyz.
+
+        The cell of every point is recomputed and checked against the
+        saved cells, which needs no sort, so it is cheaper than building
+        the index. Raises ValueError if xyz doesn't match the saved index.
+        """
+        saved = np.load(fname)
+        index = cls.__new__(cls)
+        index.cell_size = float(saved['cell_size'])
+        for name in ('lo', 'ext', 'order', 'cell_keys', 'cell_starts'):
+            setattr(index, name, saved[name])
+        xyz = np.asarray(xyz)
+        finite = np.isfinite(xyz).all(1)
+        if (len(index.order) and index.order.max() >= len(xyz)) or \
+                finite.sum() != len(index.order):
+            raise ValueError('index does not match the points')
+        dtype = np.promote_types(xyz.dtype, np.float32)
+        index.xyz = xyz[index.order].astype(dtype)
+        if not finite[index.order].all():
+            raise ValueError('index does not match the points')
+        cells = index._cells(index.xyz)
+        if not ((cells >= 0) & (cells < index.ext)).all():
+            raise ValueError('index does not match the points')
+        keys = index._keys(cells)
+        cell_keys, cell_starts = index._cell_table(keys)
+        if ((keys[1:] < keys[:-1]).any() or
+                not np.array_equal(cell_keys, index.cell_keys) or
+                not np.array_equal(cell_starts, index.cell_starts)):
+            raise ValueError('index does not match the points')
+        return index
@@ -7,6 +7,7 @@ TODO maybe download data here instead of having it in repo
 import pytest
 import numpy as np
 import os
+import sys
 import shutil
 import tempfile
 
@@ -60,7 +61,7 @@ def bin_pcd_fname():
 
 
 def cloud_centroid(pc):
-    xyz = np.empty((pc.points, 3), dtype=np.float)
+    xyz = np.empty((pc.points, 3), dtype=np.float64)
     xyz[:, 0] = pc.pc_data['x']
     xyz[:, 1] = pc.pc_data['y']
     xyz[:, 2] = pc.pc_data['z']
@@ -152,7 +153,7 @@ def test_path_roundtrip_binary(pcd_fname):
 
     pc2 = pypcd.PointCloud.from_path(tmp_fname)
     md2 = pc2.get_metadata()
-    for k, v in md2.iteritems():
+    for k, v in md2.items():
         if k == 'data':
             assert v == 'binary'
         else:
@@ -180,7 +181,7 @@ def test_path_roundtrip_binary_compressed(pcd_fname):
 
     pc2 = pypcd.PointCloud.from_path(tmp_fname)
     md2 = pc2.get_metadata()
-    for k, v in md2.iteritems():
+    for k, v in md2.items():
         if k == 'data':
             assert v == 'binary_compressed'
         else:
@@ -210,3 +211,813 @@ def test_ascii_bin1(ascii_pcd_fname, bin_pcd_fname):
     am = cloud_centroid(apc1)
     bm = cloud_centroid(bpc1)
     assert(np.allclose(am, bm))
+
+
+def make_random_pc(n=1000, fields=('x', 'y', 'z')):
+    import pypcd
+    arr = np.empty(n, dtype=[(f, np.float32) for f in fields])
+    for f in fields:
+        # quantized so that it is compressible and survives ascii
+        arr[f] = np.random.randint(0, 1000, n)/100.
+    return pypcd.PointCloud.from_array(arr)
+
+
+def test_from_path_mmap(tmpdir):
+    import pypcd
+    pc = make_random_pc()
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, compression='binary')
+
+    pc2 = pypcd.PointCloud.from_path(tmp_fname, mmap=True)
+    assert(isinstance(pc2.pc_data, np.memmap))
+    assert(pc2.points == pc.points)
+    np.testing.assert_equal(pc.pc_data, pc2.pc_data)
+
+    pc.save_pcd(tmp_fname, compression='binary_compressed')
+    with pytest.raises(ValueError):
+        pypcd.PointCloud.from_path(tmp_fname, mmap=True)
+
+
+@pytest.mark.parametrize('compression',
+                         ['ascii', 'binary', 'binary_compressed'])
+def test_from_path_fields(tmpdir, compression):
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'intensity', 'label'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, compression=compression)
+
+    pc2 = pypcd.PointCloud.from_path(tmp_fname, fields=['z', 'x'])
+    assert(pc2.fields == ['z', 'x'])
+    assert(pc2.pc_data.dtype.names == ('z', 'x'))
+    np.testing.assert_equal(pc2.pc_data['x'], pc.pc_data['x'])
+    np.testing.assert_equal(pc2.pc_data['z'], pc.pc_data['z'])
+
+    with pytest.raises(ValueError):
+        pypcd.PointCloud.from_path(tmp_fname, fields=['nope'])
+
+
+def test_from_path_mmap_fields(tmpdir):
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'intensity'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, compression='binary')
+
+    pc2 = pypcd.PointCloud.from_path(tmp_fname, mmap=True, fields=['y'])
+    assert(pc2.pc_data.dtype.names == ('y',))
+    np.testing.assert_equal(pc2.pc_data['y'], pc.pc_data['y'])
+
+
+@pytest.mark.parametrize('compression',
+                         ['ascii', 'binary', 'binary_compressed'])
+def test_iter_chunks(tmpdir, compression):
+    import pypcd
+    pc = make_random_pc(n=1000, fields=('x', 'y', 'z', 'intensity'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, compression=compression)
+
+    chunks = list(pypcd.iter_chunks(tmp_fname, chunk_points=300))
+    assert([len(c) for c in chunks] == [300, 300, 300, 100])
+    for c in chunks:
+        assert(c.dtype == pc.pc_data.dtype)
+    np.testing.assert_equal(np.concatenate(chunks), pc.pc_data)
+
+    chunks = list(pypcd.iter_chunks(tmp_fname, chunk_points=300,
+                                    fields=['intensity', 'x']))
+    assert(chunks[0].dtype.names == ('intensity', 'x'))
+    np.testing.assert_equal(np.concatenate(chunks)['intensity'],
+                            pc.pc_data['intensity'])
+
+    chunks = list(pypcd.iter_chunks(tmp_fname, chunk_points=300,
+                                    fields=['intensity', 'x'], columns=True))
+    assert([list(c) for c in chunks] == [['intensity', 'x']]*4)
+    for name in ('intensity', 'x'):
+        np.testing.assert_equal(np.concatenate([c[name] for c in chunks]),
+                                pc.pc_data[name])
+    if compression == 'binary_compressed':
+        # slices of a single decompressed buffer
+        x0, x1 = chunks[0]['x'], chunks[1]['x']
+        assert(not x0.flags.owndata)
+        assert(x1.ctypes.data == x0.ctypes.data + x0.nbytes)
+
+
+@pytest.mark.parametrize('compression', ['binary', 'binary_compressed'])
+def test_columnar(tmpdir, compression):
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'intensity'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, compression=compression)
+
+    pc2 = pypcd.PointCloud.from_path(tmp_fname, columnar=True)
+    assert(pc2.is_columnar)
+    assert(list(pc2.columns.keys()) == ['x', 'y', 'z', 'intensity'])
+    for name, column in pc2.columns.items():
+        assert(column.flags['C_CONTIGUOUS'])
+        np.testing.assert_equal(column, pc.pc_data[name])
+
+    # columnar clouds can be written without building pc_data
+    pc2.save_pcd(tmp_fname, compression='binary_compressed')
+    assert(pc2.is_columnar)
+    pc3 = pypcd.PointCloud.from_path(tmp_fname)
+    np.testing.assert_equal(pc3.pc_data, pc.pc_data)
+
+    pc4 = pc2.copy()
+    pypcd.update_field(pc4, 'x', 0.)
+    assert(np.all(pc4.columns['x'] == 0.))
+
+    # pc_data is a cached read-only copy; the cloud stays columnar
+    np.testing.assert_equal(pc2.pc_data, pc.pc_data)
+    assert(pc2.is_columnar)
+    assert(pc2.pc_data is pc2.pc_data)
+    assert(not pc2.pc_data.flags.writeable)
+    assert(pypcd.cat_point_clouds(pc2, pc2).is_columnar)
+    # and rebuilt when a column changes
+    pypcd.update_field(pc2, 'x', 1.)
+    assert(np.all(pc2.pc_data['x'] == 1.))
+    assert(pc4.is_columnar and np.all(pc4.pc_data['x'] == 0.))
+    pc4.columns['y'][:] = 2.
+    pc4.invalidate_pc_data()
+    assert(np.all(pc4.pc_data['y'] == 2.))
+    pc2.to_interleaved()
+    assert(not pc2.is_columnar)
+    pc2.pc_data['z'] = 3.
+    assert(np.all(pc2.columns['z'] == 3.))
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_load_many(tmpdir, backend):
+    import pypcd
+    pcs, fnames = [], []
+    for i, compression in enumerate(['ascii', 'binary', 'binary_compressed']):
+        pc = make_random_pc(n=100*(i+1))
+        fname = str(tmpdir.join('out%d.pcd' % i))
+        pc.save_pcd(fname, compression=compression)
+        pcs.append(pc)
+        fnames.append(fname)
+
+    pcs2 = pypcd.load_many(fnames, workers=2, backend=backend)
+    assert(len(pcs2) == len(pcs))
+    for pc, pc2 in zip(pcs, pcs2):
+        np.testing.assert_equal(pc.pc_data, pc2.pc_data)
+
+    pc3 = pypcd.load_many(fnames, workers=2, backend=backend,
+                          concatenate=True, fields=['x', 'z'])
+    assert(pc3.points == 600)
+    assert(pc3.fields == ['x', 'z'])
+    np.testing.assert_equal(pc3.pc_data['z'],
+                            np.concatenate([pc.pc_data['z'] for pc in pcs]))
+
+    # a failing load leaves no workers behind
+    import multiprocessing
+    import threading
+    with open(fnames[1], 'r+b') as f:
+        f.truncate(os.path.getsize(fnames[1]) - 100)
+    threads = threading.active_count()
+    with pytest.raises(Exception):
+        pypcd.load_many(fnames, workers=2, backend=backend,
+                        concatenate=True)
+    assert(not multiprocessing.active_children())
+    assert(threading.active_count() == threads)
+
+
+def test_codecs(tmpdir):
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'intensity'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    codecs = ['zlib'] + [c for c in ('zstd', 'lz4', 'blosc')
+                         if c in pypcd.pypcd._codecs]
+    for codec in codecs:
+        pc.save_pcd(tmp_fname, compression='binary_compressed_' + codec)
+        pc2 = pypcd.PointCloud.from_path(tmp_fname)
+        assert(pc2.data == 'binary_compressed_' + codec)
+        np.testing.assert_equal(pc.pc_data, pc2.pc_data)
+        chunks = list(pypcd.iter_chunks(tmp_fname, chunk_points=300))
+        np.testing.assert_equal(np.concatenate(chunks), pc.pc_data)
+
+    with pytest.raises(AssertionError):
+        pc.save_pcd(tmp_fname, compression='binary_compressed_nope')
+
+
+ascii_data = """\
+1.5 -2.25e1 nan 3 4 5 7
+nan 0.125 -1 65535 0 1 -3
+"""
+
+
+def test_parse_ascii_pc_data():
+    from io import BytesIO
+    from pypcd.pypcd import parse_ascii_pc_data, _build_dtype
+    md = {'fields': ['x', 'y', 'z', 'label', 'normal', 'i'],
+          'size': [4, 4, 8, 2, 1, 4],
+          'type': ['F', 'F', 'F', 'U', 'U', 'I'],
+          'count': [1, 1, 1, 1, 2, 1],
+          'points': 2}
+    dtype = _build_dtype(md)
+    pc_data = parse_ascii_pc_data(BytesIO(ascii_data.encode()), dtype, md)
+    expected = np.loadtxt(BytesIO(ascii_data.encode()), dtype=dtype)
+    assert(pc_data.dtype == dtype)
+    for name in dtype.names:
+        np.testing.assert_equal(pc_data[name], expected[name])
+    assert(pc_data['normal_0001'][1] == 1)
+    assert(pc_data['i'][1] == -3)
+
+    md = {'fields': ['x', 'y', 'z'], 'size': [4, 4, 4],
+          'type': ['F', 'F', 'F'], 'count': [1, 1, 1], 'points': 2}
+    dtype = _build_dtype(md)
+    with pytest.raises(ValueError):
+        parse_ascii_pc_data(BytesIO(b'1 2\n3 4 5 6\n'), dtype, md)
+
+
+def test_parse_ascii_pc_data_benchmark(tmpdir):
+    import time
+    import pypcd
+    from pypcd.pypcd import parse_ascii_pc_data, _build_dtype
+    pc = make_random_pc(n=50000, fields=('x', 'y', 'z', 'intensity'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, compression='ascii')
+    with open(tmp_fname, 'rb') as f:
+        md = pypcd.pypcd._read_header_from_fileobj(f)
+        buf = f.read()
+    dtype = _build_dtype(md)
+
+    from io import BytesIO
+    t0 = time.time()
+    expected = np.loadtxt(BytesIO(buf), dtype=dtype, delimiter=' ')
+    t1 = time.time()
+    pc_data = parse_ascii_pc_data(BytesIO(buf), dtype, md)
+    t2 = time.time()
+    print('ascii parse: loadtxt %.4fs, pypcd %.4fs' % (t1-t0, t2-t1))
+    np.testing.assert_equal(pc_data, expected)
+
+
+def test_write_ascii_pc_data():
+    from io import BytesIO
+    import pypcd
+    pc = make_random_pc(n=1000, fields=('x', 'y', 'z', 'intensity'))
+    pc.pc_data['z'][3] = np.nan
+    fmtstr = pypcd.build_ascii_fmtstr(pc, fmt={'intensity': '%.2f'})
+    assert(fmtstr == ['%.10f', '%.10f', '%.10f', '%.2f'])
+
+    f1, f2 = BytesIO(), BytesIO()
+    np.savetxt(f1, pc.pc_data, fmt=fmtstr)
+    pypcd.write_ascii_pc_data(f2, pc.pc_data, fmtstr)
+    assert(f1.getvalue() == f2.getvalue())
+
+
+def test_export_columns(tmpdir):
+    pc = make_random_pc(n=10, fields=('x', 'y', 'z', 'intensity', 'label'))
+    tmp_fname = str(tmpdir.join('out.txt'))
+
+    pc.export_columns(tmp_fname, ['z', 'label'], fmt=['%.2f', '%d'],
+                      delimiter=',')
+    with open(tmp_fname) as f:
+        lines = f.read().splitlines()
+    assert(len(lines) == 10)
+    assert(lines[0] == '%.2f,%d' % (pc.pc_data['z'][0],
+                                    pc.pc_data['label'][0]))
+
+    pc.save_xyz_intensity_label(tmp_fname, use_default_lbl=True)
+    with open(tmp_fname) as f:
+        lines = f.read().splitlines()
+    x, y, z, i, lbl = pc.pc_data[4]
+    assert(lines[4] == '%.4f %.4f %.4f %.4f 1000' % (x, y, z, i))
+
+    pc.save_xyz_label(tmp_fname)
+    data = np.loadtxt(tmp_fname)
+    np.testing.assert_allclose(data[:, 0], pc.pc_data['x'], atol=1e-4)
+    np.testing.assert_equal(data[:, 3], pc.pc_data['label'].astype(int))
+
+
+@pytest.mark.parametrize('compression', ['binary', 'binary_compressed'])
+def test_save_noncontiguous(tmpdir, compression):
+    import pypcd
+    pc = make_random_pc(n=1000)
+    pc2 = pypcd.PointCloud.from_array(pc.pc_data[::2])
+    pc2.pc_data = pc.pc_data[::2]
+    assert(not pc2.pc_data.flags['C_CONTIGUOUS'])
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc2.save_pcd(tmp_fname, compression=compression)
+    pc3 = pypcd.PointCloud.from_path(tmp_fname)
+    np.testing.assert_equal(pc3.pc_data, pc.pc_data[::2])
+
+
+@pytest.mark.parametrize('compression', ['ascii', 'binary',
+                                         'binary_compressed',
+                                         'binary_compressed_zlib'])
+def test_pcd_writer(tmpdir, compression):
+    import pypcd
+    pc = make_random_pc(n=1000, fields=('x', 'y', 'z', 'intensity'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    with pypcd.PCDWriter(tmp_fname, pc.pc_data.dtype,
+                         data=compression) as writer:
+        for start in range(0, 1000, 300):
+            writer.append(pc.pc_data[start:start+300])
+    assert(writer.points == 1000)
+
+    pc2 = pypcd.PointCloud.from_path(tmp_fname)
+    assert(pc2.points == pc2.width == 1000)
+    assert(pc2.data == compression)
+    np.testing.assert_equal(pc2.pc_data, pc.pc_data)
+
+
+def test_pcd_writer_metadata(tmpdir):
+    import pypcd
+    md = {'fields': ['x', 'normal'], 'size': [4, 4], 'type': ['F', 'F'],
+          'count': [1, 3]}
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    chunk = np.ones(10, dtype=pypcd.pypcd._build_dtype(md))
+    with pypcd.PCDWriter(tmp_fname, md) as writer:
+        writer.append(chunk)
+        writer.append(chunk)
+    pc = pypcd.PointCloud.from_path(tmp_fname)
+    assert(pc.fields == ['x', 'normal'])
+    assert(pc.count == [1, 3])
+    assert(pc.points == 20)
+
+
+def test_cat_point_clouds_nary():
+    import pypcd
+    pcs = [make_random_pc(n=100*(i+1)) for i in range(3)]
+    pc = pypcd.cat_point_clouds(*pcs)
+    assert(pc.points == pc.width == 600)
+    np.testing.assert_equal(pc.pc_data,
+                            np.concatenate([p.pc_data for p in pcs]))
+
+
+def test_point_cloud_builder():
+    import pypcd
+    pcs = [make_random_pc(n=100*(i+1)) for i in range(5)]
+    builder = pypcd.PointCloudBuilder(capacity=10)
+    for pc in pcs:
+        builder.append(pc)
+    builder.append(pcs[0].pc_data)
+    pc = builder.build()
+    assert(pc.points == pc.width == 1600)
+    assert(pc.fields == pcs[0].fields)
+    np.testing.assert_equal(pc.pc_data, np.concatenate(
+        [p.pc_data for p in pcs] + [pcs[0].pc_data]))
+
+    with pytest.raises(ValueError):
+        builder.append(make_random_pc(fields=('x', 'y')))
+
+
+def test_validate():
+    import pypcd
+    pc = make_random_pc(n=10)
+    md = pc.get_metadata()
+    md['points'] = 11
+    with pytest.raises(AssertionError):
+        pypcd.PointCloud(md, pc.pc_data)
+    pc2 = pypcd.PointCloud(md, pc.pc_data, validate=False)
+    assert(pc2.points == 11)
+    # headers are validated once, when built
+    with pytest.raises(ValueError):
+        pypcd.PCDHeader.from_metadata(md)
+    header = pc.header
+    pc3 = pypcd.PointCloud(header, pc.pc_data)
+    assert(pc3.header is header and pc3.points == 10)
+    with pytest.raises(AssertionError):
+        pypcd.PointCloud(header, pc.pc_data[:5])
+
+
+def test_pcd_header():
+    import pypcd
+    from pypcd.pypcd import parse_header
+    md = parse_header(header2.split('\n'))
+    h1 = pypcd.PCDHeader.from_metadata(md)
+    h2 = pypcd.PCDHeader.from_metadata(parse_header(header2.split('\n')))
+    assert(h1 == h2)
+    assert(h1.dtype is h2.dtype)
+    assert(h1.point_step == h1.dtype.itemsize == 17*4)
+    assert(h1.offsets[:3] == (0, 4, 8))
+    assert(h1.fields[0] == 'x')
+    with pytest.raises(AttributeError):
+        h1.width = 3
+    h3 = h1.replace(width=10, points=10)
+    assert(h3.points == 10 and h1.points == 19812)
+    assert(h3.to_metadata()['fields'] == md['fields'])
+
+    assert(hash(h1) == hash(h2))
+    assert({h1: 1}[h2] == 1)
+
+    pc = make_random_pc(n=10)
+    assert(pc.header.points == 10)
+    assert(pc.header.dtype == pc.pc_data.dtype)
+    # cached until the metadata or data are assigned
+    assert(pc.header is pc.header)
+    header = pc.header
+    pc.width = pc.points = 5
+    pc.pc_data = pc.pc_data[:5]
+    assert(pc.header is not header and pc.header.points == 5)
+
+
+def test_read_header(tmpdir):
+    import pypcd
+    pc = make_random_pc(n=1000)
+    fnames = []
+    for compression in ('ascii', 'binary', 'binary_compressed'):
+        fname = str(tmpdir.join('%s.pcd' % compression))
+        pc.save_pcd(fname, compression=compression)
+        fnames.append(fname)
+
+    headers = pypcd.read_headers(fnames, workers=2)
+    for fname, h in zip(fnames, headers):
+        assert(h['metadata']['points'] == 1000)
+        assert(h['metadata']['fields'] == ['x', 'y', 'z'])
+        with open(fname, 'rb') as f:
+            header = f.read(h['offset'])
+        assert(header.endswith(
+            ('DATA %s\n' % h['metadata']['data']).encode()))
+    assert(headers[1]['compressed_size'] is None)
+    h = headers[2]
+    assert(h['uncompressed_size'] == 1000*3*4)
+    assert(os.path.getsize(fnames[2]) == h['offset'] + 8 +
+           h['compressed_size'])
+
+
+def test_parse_header_variants():
+    from pypcd.pypcd import parse_header
+    lines = [b'# .PCD v.5 - Point Cloud Data file format',
+             b'VERSION .5',
+             b'COLUMNS x y z',
+             b'SIZE 4 4 4',
+             b'TYPE F F F',
+             b'POINTS 10',
+             b'VIEWPOINT -1.5 2e-3 0 1 0 0 0',
+             b'DATA ascii']
+    md = parse_header(lines)
+    assert(md['version'] == '.5')
+    assert(md['fields'] == ['x', 'y', 'z'])
+    assert(md['count'] == [1, 1, 1])
+    assert(md['width'] == 10 and md['height'] == 1)
+    assert(md['viewpoint'] == [-1.5, 0.002, 0, 1, 0, 0, 0])
+    assert(md['data'] == 'ascii')
+    assert(parse_header([ln.decode() for ln in lines]) == md)
+
+
+def test_parse_header_benchmark():
+    import timeit
+    from pypcd.pypcd import parse_header
+    lines = header2.split('\n')
+    n = 2000
+    t = timeit.timeit(lambda: parse_header(lines), number=n)
+    print('parse_header: %.1fus per header' % (1e6*t/n))
+    assert(parse_header(lines)['points'] == 19812)
+
+
+@pytest.mark.parametrize('compression',
+                         ['ascii', 'binary', 'binary_compressed'])
+def test_buffer_roundtrip_bytes(compression):
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'label'))
+    buf = pc.save_pcd_to_buffer(compression)
+    assert(isinstance(buf, bytes))
+    assert(buf.startswith(b'VERSION'))
+    pc2 = pypcd.PointCloud.from_buffer(buf)
+    np.testing.assert_equal(pc.pc_data, pc2.pc_data)
+
+
+def test_from_buffer_zero_copy():
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'label'))
+    buf = bytearray(pc.save_pcd_to_buffer('binary'))
+    pc2 = pypcd.PointCloud.from_buffer(buf, copy=False)
+    np.testing.assert_equal(pc.pc_data, pc2.pc_data)
+    assert(not pc2.pc_data.flags.writeable)
+    # a view: changes to the buffer show through
+    buf[-4:] = np.float32(-1).tobytes()
+    assert(pc2.pc_data['label'][-1] == -1)
+    pc3 = pypcd.PointCloud.from_buffer(memoryview(buf))
+    assert(pc3.pc_data.flags.writeable)
+    pc3.pc_data['x'][0] = 123
+    assert(pc2.pc_data['x'][0] == pc.pc_data['x'][0])
+    pc4 = pypcd.PointCloud.from_buffer(bytes(buf), fields=['y'], copy=False)
+    np.testing.assert_equal(pc4.pc_data['y'], pc.pc_data['y'])
+    with pytest.raises(ValueError):
+        pypcd.point_cloud_from_buffer(bytes(buf[:-4]))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='needs asyncio')
+@pytest.mark.parametrize('compression',
+                         ['ascii', 'binary', 'binary_compressed'])
+def test_aload_asave(tmpdir, compression):
+    import asyncio
+    import pypcd
+    pc = make_random_pc(fields=('x', 'y', 'z', 'label'))
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(pc.asave(tmp_fname, compression,
+                                         chunk_points=300))
+        pc2 = loop.run_until_complete(pypcd.aload(tmp_fname,
+                                                  chunk_points=300))
+        pc3 = loop.run_until_complete(pypcd.aload(tmp_fname, fields=['y'],
+                                                  chunk_points=300))
+    finally:
+        loop.close()
+    assert(pc2.data == compression)
+    np.testing.assert_equal(pc.pc_data, pc2.pc_data)
+    np.testing.assert_equal(pc.pc_data['y'], pc3.pc_data['y'])
+    assert(os.listdir(str(tmpdir)) == ['out.pcd'])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='needs asyncio')
+def test_aload_asave_cancel(tmpdir):
+    import asyncio
+    import pypcd
+    pc = make_random_pc()
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, 'binary')
+    loop = asyncio.new_event_loop()
+    try:
+        for coro in (pypcd.aload(tmp_fname, chunk_points=10),
+                     pc.asave(str(tmpdir.join('out2.pcd')), 'binary',
+                              chunk_points=10)):
+            task = loop.create_task(coro)
+            loop.call_soon(task.cancel)
+            with pytest.raises(asyncio.CancelledError):
+                loop.run_until_complete(task)
+    finally:
+        loop.close()
+    assert(os.listdir(str(tmpdir)) == ['out.pcd'])
+
+
+def test_voxel_downsample():
+    import pypcd
+    arr = np.zeros(6, dtype=[('x', np.float32), ('y', np.float32),
+                             ('z', np.float32), ('label', np.int32)])
+    arr['x'] = [0.1, 0.3, 1.5, 1.7, np.nan, -0.2]
+    arr['label'] = [1, 2, 3, 6, 7, 8]
+    pc = pypcd.PointCloud.from_array(arr)
+    first = pc.voxel_downsample(1.0, 'first')
+    assert(first.points == first.width == 3)
+    np.testing.assert_equal(first.pc_data['label'], [8, 1, 3])
+    centroid = pc.voxel_downsample(1.0)
+    np.testing.assert_allclose(centroid.pc_data['x'], [-0.2, 0.2, 1.6],
+                               rtol=1e-6)
+    np.testing.assert_equal(centroid.pc_data['label'], [8, 1, 3])
+    mean = pc.voxel_downsample([1.0, 1.0, 1.0], 'mean_all_fields',
+                               chunk_points=2)
+    np.testing.assert_allclose(mean.pc_data['x'], [-0.2, 0.2, 1.6],
+                               rtol=1e-6)
+    np.testing.assert_equal(mean.pc_data['label'], [8, 2, 4])
+    mean.check_sanity()
+    with pytest.raises(ValueError):
+        pc.voxel_downsample(1.0, 'median')
+
+
+def test_voxel_downsample_rgb():
+    from pypcd import sautil, rgbutil
+    arr = np.zeros(3, dtype=[('x', np.float32), ('y', np.float32),
+                             ('z', np.float32), ('rgb', np.float32)])
+    arr['x'] = [0.1, 0.3, 1.5]
+    # red and blue in one voxel, green in another
+    colors = np.array([[255, 0, 0], [0, 0, 255], [0, 255, 0]], np.uint8)
+    arr['rgb'] = rgbutil.encode_rgb(colors)
+    out = sautil.voxel_downsample(arr, 1.0, 'mean_all_fields')
+    np.testing.assert_equal(rgbutil.decode_rgb(out['rgb']),
+                            [[128, 0, 128], [0, 255, 0]])
+
+
+def test_voxel_downsample_random():
+    pc = make_random_pc(n=100000)
+    ds = pc.voxel_downsample(0.5)
+    xyz = np.stack([pc.pc_data[f] for f in 'xyz'], 1)
+    voxels = np.unique(np.floor(xyz/0.5), axis=0)
+    assert(ds.points == len(voxels))
+    ds_xyz = np.stack([ds.pc_data[f] for f in 'xyz'], 1)
+    # centroids stay in their voxel
+    np.testing.assert_equal(np.floor(ds_xyz/0.5), voxels)
+
+
+def test_spatial_index(tmpdir):
+    pc = make_random_pc(n=2000)
+    pc.pc_data['x'][:5] = np.nan
+    xyz = np.stack([pc.pc_data[f] for f in 'xyz'], 1).astype(np.float64)
+    pts = np.random.uniform(-1, 11, (50, 3))
+    d = np.sqrt(((pts[:, None, :] - xyz[None, :, :])**2).sum(-1))
+    d[np.isnan(d)] = np.inf
+    neighbors = pc.index.query_radius(pts, 1.5)
+    for i in range(len(pts)):
+        np.testing.assert_equal(np.sort(neighbors[i]),
+                                np.flatnonzero(d[i] <= 1.5))
+    dist, idx = pc.index.knn(pts, 7)
+    np.testing.assert_allclose(dist, np.sort(d, 1)[:, :7], rtol=1e-5)
+    np.testing.assert_allclose(d[np.arange(len(pts))[:, None], idx], dist,
+                               rtol=1e-5)
+    # cached, saved, and dropped when the points move
+    assert(pc.index is pc.index)
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, 'binary')
+    pc.save_index(tmp_fname)
+    import pypcd
+    pc2 = pypcd.PointCloud.from_path(tmp_fname)
+    pc2.load_index(tmp_fname)
+    np.testing.assert_equal(pc2.index.knn(pts, 7)[1], idx)
+    index = pc.index
+    pypcd.update_field(pc, 'x', pc.pc_data['x'] + 1)
+    assert(pc.index is not index)
+    # the saved index no longer matches pc
+    with pytest.raises(ValueError):
+        pc.load_index(tmp_fname)
+
+
+def random_pose():
+    # rotation from the QR decomposition of a random matrix
+    Q, R = np.linalg.qr(np.random.randn(3, 3))
+    Q *= np.sign(np.diag(R))
+    if np.linalg.det(Q) < 0:
+        Q[:, 0] = -Q[:, 0]
+    T = np.eye(4)
+    T[:3, :3] = Q
+    T[:3, 3] = np.random.randn(3)
+    return T
+
+
+def test_transform_cloud_array():
+    from pypcd import sautil
+    arr = np.zeros(1000, dtype=[('x', np.float64), ('y', np.float64),
+                                ('z', np.float64), ('x_origin', np.float64),
+                                ('y_origin', np.float64),
+                                ('z_origin', np.float64)])
+    for name in arr.dtype.names:
+        arr[name] = np.random.randn(len(arr))
+    T = random_pose()
+    xyz = np.stack([arr['x'], arr['y'], arr['z']], 1)
+    origin = np.stack([arr['x_origin'], arr['y_origin'], arr['z_origin']], 1)
+    sautil.transform_cloud_array(T, arr, block_points=300)
+    np.testing.assert_allclose(sautil.get_xyz_array(arr, np.float64),
+                               np.dot(xyz, T[:3, :3].T) + T[:3, 3])
+    np.testing.assert_allclose(
+        sautil.get_xyz_viewpoint_array(arr, np.float64),
+        np.dot(origin, T[:3, :3].T) + T[:3, 3])
+
+
+def test_transform_point_cloud():
+    from pypcd import sautil
+    pcs = [make_random_pc(), make_random_pc()]
+    pcs[1].to_columnar()
+    xyzs = [sautil.get_xyz_array(pc.pc_data, np.float64) for pc in pcs]
+    Ts = [random_pose(), random_pose()]
+    sautil.transform_cloud_arrays(Ts, pcs, workers=2)
+    for pc, xyz, T in zip(pcs, xyzs, Ts):
+        np.testing.assert_allclose(sautil.get_xyz_array(pc.pc_data,
+                                                        np.float64),
+                                   np.dot(xyz, T[:3, :3].T) + T[:3, 3],
+                                   rtol=1e-5, atol=1e-5)
+        # the viewpoint is now the pose T
+        vp = np.array(pc.viewpoint)
+        np.testing.assert_allclose(vp[:3], T[:3, 3])
+        np.testing.assert_allclose(sautil._quaternion_to_rotation(vp[3:]),
+                                   T[:3, :3], atol=1e-12)
+    # back again
+    T_inv = np.linalg.inv(Ts[0])
+    sautil.transform_cloud_array(T_inv, pcs[0])
+    np.testing.assert_allclose(pcs[0].viewpoint,
+                               [0, 0, 0, 1, 0, 0, 0], atol=1e-12)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_merge_transformed(tmpdir, workers):
+    import pypcd
+    from pypcd import sautil
+    pcs = [make_random_pc(n=n, fields=('x', 'y', 'z', 'label'))
+           for n in (100, 50, 250, 30)]
+    poses = [random_pose() for _ in pcs]
+    fnames = []
+    for i, pc in enumerate(pcs):
+        fnames.append(str(tmpdir.join('%d.pcd' % i)))
+        pc.save_pcd(fnames[-1], 'binary_compressed')
+    expected = []
+    for pc, T in zip(pcs, poses):
+        expected.append(sautil.transform_cloud_array(T, pc.pc_data.copy()))
+    expected = np.concatenate(expected)
+    inputs = [pcs[0], fnames[1], fnames[2], pcs[3]]
+    merged = pypcd.merge_transformed(inputs, poses, workers=workers)
+    assert(merged.points == 430)
+    for name in ('x', 'y', 'z', 'label'):
+        np.testing.assert_allclose(merged.pc_data[name], expected[name],
+                                   rtol=1e-5, atol=1e-5)
+    # the inputs are unchanged
+    np.testing.assert_equal(pcs[0].pc_data,
+                            pypcd.point_cloud_from_path(fnames[0]).pc_data)
+    out_fname = str(tmpdir.join('merged.pcd'))
+    pypcd.merge_transformed(inputs, poses, out=out_fname, workers=workers,
+                            fields=['x', 'y', 'z'])
+    streamed = pypcd.point_cloud_from_path(out_fname)
+    assert(streamed.fields == ['x', 'y', 'z'])
+    np.testing.assert_equal(streamed.pc_data['z'], merged.pc_data['z'])
+    with pytest.raises(ValueError):
+        pypcd.merge_transformed(inputs, poses[1:])
+
+
+def test_encode_decode_rgb():
+    import pypcd
+    rgba = np.random.randint(0, 256, (100, 4)).astype(np.uint8)
+    packed = pypcd.encode_rgb_for_pcl(rgba[:, :3])
+    as_int = rgba[:, :3].astype(np.uint32)
+    np.testing.assert_equal(
+        packed.view(np.uint32),
+        (as_int[:, 0] << 16) | (as_int[:, 1] << 8) | as_int[:, 2])
+    np.testing.assert_equal(pypcd.decode_rgb_from_pcl(packed), rgba[:, :3])
+    packed = pypcd.encode_rgb_for_pcl(rgba)
+    np.testing.assert_equal(packed.view(np.uint32) >> 24, rgba[:, 3])
+    np.testing.assert_equal(pypcd.decode_rgb_from_pcl(packed, alpha=True),
+                            rgba)
+    # the same colors stored big-endian
+    packed_be = packed.astype('>f4')
+    np.testing.assert_equal(pypcd.decode_rgb_from_pcl(packed_be, alpha=True),
+                            rgba)
+
+
+def test_point_cloud_rgb():
+    import pypcd
+    rgb = np.random.randint(0, 256, (100, 3)).astype(np.uint8)
+    arr = np.zeros(100, dtype=[('x', np.float32), ('y', np.float32),
+                               ('z', np.float32), ('rgb', np.float32)])
+    arr['rgb'] = pypcd.encode_rgb_for_pcl(rgb)
+    pc = pypcd.PointCloud.from_array(arr)
+    np.testing.assert_equal(pc.rgb, rgb)
+    # a view: writes change the cloud
+    pc.rgb[:, 1] = 7
+    pc.alpha[:] = 255
+    decoded = pypcd.decode_rgb_from_pcl(pc.pc_data['rgb'], alpha=True)
+    np.testing.assert_equal(decoded[:, 1], 7)
+    np.testing.assert_equal(decoded[:, 3], 255)
+    assert(np.shares_memory(pc.rgb, pc.pc_data))
+    with pytest.raises(ValueError):
+        make_random_pc().rgb
+
+
+def test_spatial_index_stale(tmpdir):
+    from pypcd import sautil
+    pc = make_random_pc(n=2000)
+    index = pc.index
+    T = np.eye(4)
+    T[0, 3] = 100
+    # the cloud doesn't know its array was transformed
+    sautil.transform_cloud_array(T, pc.pc_data)
+    assert(pc.index is index)
+    pc.invalidate_index()
+    assert(pc.index is not index)
+    x, y, z = pc.pc_data[0]['x'], pc.pc_data[0]['y'], pc.pc_data[0]['z']
+    assert(0 in pc.index.query_radius([[x, y, z]], 0.01)[0])
+    # a saved index is rejected when an interior point moved
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_index(tmp_fname)
+    pc2 = pc.copy()
+    x = pc2.pc_data['x']
+    i = np.argsort(x)[len(x)//2]
+    x[i] = x[i] + 3.3
+    with pytest.raises(ValueError):
+        pc2.load_index(tmp_fname)
+
+
+def test_spatial_index_surface():
+    from pypcd import spatial
+    # points on a thin plate fill few of the cells of their bounding box
+    xyz = np.random.uniform(0, 1, (20000, 3)) * [100, 100, 0.1]
+    index = spatial.VoxelIndex(xyz)
+    assert(len(index) / float(len(index.cell_keys)) < 10)
+    # queries off the surface, with a small candidate budget
+    index.max_candidates = 5000
+    pts = np.random.uniform(0, 100, (30, 3))
+    d = np.sqrt(((pts[:, None, :] - xyz[None, :, :])**2).sum(-1))
+    dist, idx = index.knn(pts, 3)
+    np.testing.assert_allclose(dist, np.sort(d, 1)[:, :3])
+    # and on it
+    pts = xyz[:30] + 0.1
+    d = np.sqrt(((pts[:, None, :] - xyz[None, :, :])**2).sum(-1))
+    neighbors = index.query_radius(pts, 2.)
+    for i in range(len(pts)):
+        np.testing.assert_equal(np.sort(neighbors[i]),
+                                np.flatnonzero(d[i] <= 2.))
+
+
+def test_build_index():
+    import pypcd
+    pc = make_random_pc(n=2000)
+    index = pc.build_index(cell_size=0.5)
+    assert(index.cell_size == 0.5)
+    assert(pc.index is index)
+    # pc_data of make_xyz_point_cloud has shape (N, 1)
+    xyz = np.random.rand(100, 3)
+    pc = pypcd.make_xyz_point_cloud(xyz)
+    assert(len(pc.index) == 100)
+    assert(pc.index.knn(xyz[:1], 1)[1][0, 0] == 0)
+
+
+def test_missing_codec(tmpdir):
+    import pypcd
+    from pypcd import pypcd as pypcd_mod
+    pc = make_random_pc()
+    tmp_fname = str(tmpdir.join('out.pcd'))
+    pc.save_pcd(tmp_fname, 'binary_compressed_zlib')
+    codec = pypcd_mod._codecs.pop('zlib')
+    try:
+        with pytest.raises(ValueError) as e:
+            pypcd.point_cloud_from_path(tmp_fname)
+        assert('zlib' in str(e.value))
+        with pytest.raises(ValueError):
+            next(pypcd.iter_chunks(tmp_fname))
+    finally:
+        pypcd_mod._codecs['zlib'] = codec